@@ -1,21 +1,27 @@
 import boto3
 import os
+import random
 import uuid
+import hashlib
 import json
 import time ### NEW V2 CODE ###
 import datetime
 import logging
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 from botocore.config import Config ### NEW V2 CODE ###
-from assume_role import assume_role
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 ### BEGIN NEW V2 CODE ###
 # Variables used for the retry logic:
-sleep_timer = 10 # Number of seconds to wait between custom retries
+backoff_base = 0.5 # Seconds for the first custom retry of UnprocessedItems, doubled (with jitter) on each retry
+backoff_cap = 20 # Max seconds to wait between custom retries
 max_retries = 20 # max_retries used for both custom and built-in retry logic
 config = Config(
    retries = {
@@ -25,10 +31,17 @@ config = Config(
 )
 ### END NEW V2 CODE ###
 
+# Security Hub BatchImportFindings limits: RateLimit = 10/s, BurstLimit = 30/s, 100 findings per call
+sechub_rate_limit = 10
+sechub_burst_limit = 30
+sechub_batch_size = 100
+sechub_max_retries = 5  # number of times a failed finding is requeued before it is logged and dropped
+
 stsclient = boto3.client('sts')
 shclient = boto3.client('securityhub')
 dbclient = boto3.client('dynamodb', config=config) ### NEW V2 CODE ###
 dbresource = boto3.resource('dynamodb')
+thread_local = threading.local()  # boto3 resources are not thread safe, so each worker gets its own
 lambdaclient = boto3.client('lambda')
 # eksclient = boto3.client('eks')
 ec2client = boto3.client('ec2')
@@ -40,6 +53,53 @@ db_index = os.environ['DYNAMODB_INDEX']
 db_key = os.environ['DYNAMODB_KEY']
 excluded_accounts = os.environ['EXCLUDED_ACCOUNTS']  # comma separated list of account IDs
 x_account_role = os.environ['X_ACCOUNT_ROLE']
+# Orchestration settings: 'inline' runs main() for every account on a worker pool inside this invocation,
+# 'invoke' fans out one async Lambda invocation per account, 'auto' picks 'invoke' above INLINE_MAX_ACCOUNTS
+orchestration_mode = os.environ.get('ORCHESTRATION_MODE', 'auto')
+inline_max_accounts = int(os.environ.get('INLINE_MAX_ACCOUNTS', '250'))
+max_workers = int(os.environ.get('MAX_WORKERS', '16'))
+account_timeout = int(os.environ.get('ACCOUNT_TIMEOUT', '300'))  # seconds allowed per account in inline mode
+accounts_per_invoke = int(os.environ.get('ACCOUNTS_PER_INVOKE', '1'))  # accounts handled by each child invocation in invoke mode
+# Cluster enumeration settings: CLUSTER_STATES is a comma separated list of EMR cluster states (empty for all),
+# CLUSTER_LOOKBACK_DAYS limits the terminated clusters to the ones created within that many days (active clusters
+# are always listed), SCAN_MODE 'incremental' only evaluates clusters created or changed since the account's last
+# successful scan
+cluster_states = [state for state in os.environ.get('CLUSTER_STATES', '').replace(' ', '').split(',') if state]
+cluster_lookback_days = int(os.environ.get('CLUSTER_LOOKBACK_DAYS', '60'))
+scan_mode = os.environ.get('SCAN_MODE', 'full')
+checkpoint_prefix = 'CHECKPOINT#'
+# Findings table attributes read by main()
+db_projection = ['Cluster Arn', db_key, 'Account ID', 'Region', 'Compliance Status', 'Finding ID', 'Last Scan', 'Snapshot',
+                 'Fingerprint', 'Updated At']
+# Unchanged findings are still re-imported once they are this old, well inside the 90 day row TTL
+# and the Security Hub 90 day finding retention
+heartbeat_days = int(os.environ.get('HEARTBEAT_DAYS', '30'))
+terminated_states = ('TERMINATED', 'TERMINATED_WITH_ERRORS')
+active_states = ('STARTING', 'BOOTSTRAPPING', 'RUNNING', 'WAITING', 'TERMINATING')
+# ClusterSnapshot by cluster ID, reused across warm invocations. Least recently used entries are evicted
+# beyond SNAPSHOT_CACHE_SIZE and archived clusters are removed
+terminated_snapshots = collections.OrderedDict()
+terminated_snapshots_lock = threading.Lock()
+snapshot_cache_size = int(os.environ.get('SNAPSHOT_CACHE_SIZE', '20000'))
+# Account list settings: ACCOUNTS_INDEX names a GSI with Status as the partition key and Usage as the sort key
+accounts_table = os.environ.get('ACCOUNTS_TABLE', 'org-Organizations-OUAccountsTable-Table')
+accounts_index = os.environ.get('ACCOUNTS_INDEX', '')
+account_list_ttl = int(os.environ.get('ACCOUNT_LIST_TTL', '900'))
+account_list_cache = None
+account_list_loaded = 0
+# Seconds before credential expiry that a cached session is replaced. The credentials of an assumed role session
+# do not refresh, so a session is only reused when it outlives a whole invocation (the Lambda maximum of 900
+# seconds plus a minute); the default one hour sessions are reused for about 44 minutes
+session_refresh_margin = int(os.environ.get('SESSION_REFRESH_MARGIN', '960'))
+account_sessions = {}  # AccountSession by (account ID, role name), reused across warm invocations
+account_sessions_lock = threading.Lock()
+# Regions scanned in every account, REGIONS is a comma separated list (defaults to the Lambda's own region)
+home_region = os.environ['AWS_REGION']
+scan_regions = [region for region in os.environ.get('REGIONS', home_region).replace(' ', '').split(',') if region]
+region_workers = int(os.environ.get('REGION_WORKERS', '4'))
+metrics_namespace = os.environ.get('METRICS_NAMESPACE', 'EMRBootstrapCompliance')
+throttle_error_codes = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'LimitExceededException',
+                        'ProvisionedThroughputExceededException', 'RequestLimitExceeded')
 hub_account = stsclient.get_caller_identity()['Account']
 
 
@@ -49,6 +109,8 @@ def lambda_handler(event, context):
     account_id = event.get('account_id',
                            None)  # ***********DYNAMIC-Live*************** (must use the Event Rule to trigger function)
     org_name = event.get('account_name', None) ### NEW V2 CODE ###
+    batch = event.get('accounts', None)  # list of {'account_id', 'account_name'} when a child covers several accounts
+    heartbeat = event.get('heartbeat', False)  # refresh every unchanged finding (low-frequency schedule)
     ### If 'ALL' is passed in for 'EXCLUDED_ACCOUNTS', then execute a test run against only the org-SBX or ADO11 account
     ### Intended for testing or troubleshooting purposes without calling all accounts or having to explicitly exclude all accounts
     ### This IF statement can be removed later for cleaner code with no impact to the function
@@ -56,120 +118,242 @@ def lambda_handler(event, context):
         account_id = '123456789012'  # org-SBX
         source = 'TestRun'  # If source is 'aws.events' it will loop through all accounts - don't do that!
 
-    ### BEGIN NEW V2 CODE - Removed account list table scan for every invocation ###
-    accts = get_account_list()
-
-    # If account_id is not present, it's the orchestration invocation, so process the list of accounts
-    if not account_id and source == 'aws.events':
-        accts = get_account_list() ### NEW V2 CODE ###
-        excluded_account_list = excluded_accounts.replace(' ', '')
-        excluded_account_list = excluded_account_list.split(',')
-        logger.info(f'Begin invoking lambda functions on {len(accts)} accounts')
-        logger.info(f'There are {len(excluded_account_list)} excluded accounts: {excluded_accounts}')
-        for acct in accts:
-            acct_id = acct['ID']['S']
-            acct_name = acct['Name']['S']
+    try:
+        # If account_id is not present, it's the orchestration invocation, so process the list of accounts
+        if batch:
+            process_account_batch(batch, heartbeat)
+        elif not account_id and source == 'aws.events':
+            accts = get_account_list()
+            excluded_account_list = excluded_accounts.replace(' ', '')
+            excluded_account_list = excluded_account_list.split(',')
+            logger.info(f'There are {len(excluded_account_list)} excluded accounts: {excluded_accounts}')
+            mode = orchestration_mode
+            if mode == 'auto':
+                mode = 'inline' if len(accts) <= inline_max_accounts else 'invoke'
+            if mode == 'inline':
+                summary = process_accounts_inline(accts, excluded_account_list, context, heartbeat)
+                logger.info(json.dumps(summary, default=str))
+            else:
+                invoke_accounts(accts, context, heartbeat)
+        elif not account_id and not source:
+            raise Exception('Missing required parameter "account_id"')
+        else:
+            # '''Assume role on target account (accountId)'''
+            if account_id in excluded_accounts:
+                logger.info(f'Bypassing excluded account: {org_name}/{account_id}')
+            else:
+                # Process the roles in the account for the invoked lambda from the 'accts' FOR loop above
+                result = main(account_id, org_name, heartbeat=heartbeat)
+                logger.info(result)
+    finally:
+        # Publish the per-operation metrics for this invocation as Embedded Metric Format log lines
+        metrics.flush()
+
+
+def invoke_accounts(accts, context, heartbeat=False):
+    # Fallback for very large orgs: fan out async Lambda invocations covering accounts_per_invoke accounts each
+    logger.info(f'Begin invoking lambda functions on {len(accts)} accounts')
+    for i in range(0, len(accts), accounts_per_invoke):
+        chunk = accts[i:i + accounts_per_invoke]
+        if len(chunk) == 1:
             payload = {
-                'account_id': acct_id,
-                'account_name': acct_name
+                'account_id': chunk[0]['ID']['S'],
+                'account_name': chunk[0]['Name']['S']
             }
-            try:
-                lambda_response = lambdaclient.invoke(FunctionName=context.function_name,
-                                                      InvocationType='Event', Payload=json.dumps(payload, default=str))
-                # logger.debug(lambda_response)
-            except Exception:
-                logger.exception(f'Error invoking the Lambda function for account: {acct_id}')
-    elif not account_id and not source:
-        raise Exception('Missing required parameter "account_id"')
-    else:
-        # '''Assume role on target account (accountId)'''
-        if account_id in excluded_accounts:
-            logger.info(f'Bypassing excluded account: {org_name}/{account_id}')
         else:
-            # Process the roles in the account for the invoked lambda from the 'accts' FOR loop above
-            result = main(account_id, org_name)
+            payload = {
+                'accounts': [{'account_id': acct['ID']['S'], 'account_name': acct['Name']['S']} for acct in chunk]
+            }
+        if heartbeat:
+            payload['heartbeat'] = True
+        try:
+            lambda_response = lambdaclient.invoke(FunctionName=context.function_name,
+                                                  InvocationType='Event', Payload=json.dumps(payload, default=str))
+            # logger.debug(lambda_response)
+        except Exception:
+            logger.exception(f"Error invoking the Lambda function for accounts: {[acct['ID']['S'] for acct in chunk]}")
+
+
+def process_account_batch(batch, heartbeat=False):
+    # Child invocation covering several accounts: read their findings concurrently, then process each account
+    batch = [acct for acct in batch if acct['account_id'] not in excluded_accounts]
+    account_db_items = query_db_items_for_accounts([acct['account_id'] for acct in batch], db_table, db_index)
+    for acct in batch:
+        try:
+            result = main(acct['account_id'], acct['account_name'], account_db_items[acct['account_id']], heartbeat)
             logger.info(result)
+        except Exception:
+            logger.exception(f"Error processing account: {acct['account_id']}")
+
+
+def process_accounts_inline(accts, excluded_account_list, context=None, heartbeat=False):
+    # Run main() for each account on a bounded worker pool and return a summary of the results.
+    # Threads cannot be killed, so an account that exceeds the timeout is abandoned (reported as timed out)
+    # rather than stopped; the pool is shut down without waiting for it. Accounts that have not started
+    # when the Lambda is about to time out are handed to invoke_accounts so they are still scanned.
+    summary = {'completed': [], 'failed': [], 'timed_out': [], 'excluded': [], 'invoked': []}
+    started = {}
+    pending = {}
+    accts_by_id = {}
+
+    def run(acct_id, acct_name):
+        started[acct_id] = time.monotonic()
+        return main(acct_id, acct_name, heartbeat=heartbeat)
+
+    logger.info(f'Begin processing {len(accts)} accounts inline with {max_workers} workers')
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    for acct in accts:
+        acct_id = acct['ID']['S']
+        acct_name = acct['Name']['S']
+        if acct_id in excluded_account_list:
+            logger.info(f'Bypassing excluded account: {acct_name}/{acct_id}')
+            summary['excluded'].append(acct_id)
+            continue
+        pending[executor.submit(run, acct_id, acct_name)] = acct_id
+        accts_by_id[acct_id] = acct
 
+    while pending:
+        done, not_done = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            acct_id = pending.pop(future)
+            try:
+                logger.info(future.result())
+                summary['completed'].append(acct_id)
+            except Exception:
+                logger.exception(f'Error processing account: {acct_id}')
+                summary['failed'].append(acct_id)
+        now = time.monotonic()
+        for future in not_done:
+            acct_id = pending[future]
+            if acct_id in started and now - started[acct_id] > account_timeout:
+                logger.error(f'Account {acct_id} exceeded the {account_timeout} second timeout')
+                pending.pop(future)
+                summary['timed_out'].append(acct_id)
+        # Stop waiting before the Lambda itself times out
+        if context and pending and context.get_remaining_time_in_millis() < 15000:
+            logger.error(f'Lambda is about to time out with {len(pending)} accounts still pending')
+            unstarted = []
+            for future, acct_id in pending.items():
+                # cancel() only succeeds for accounts a worker has not picked up yet
+                if future.cancel():
+                    unstarted.append(accts_by_id[acct_id])
+                    summary['invoked'].append(acct_id)
+                else:
+                    summary['timed_out'].append(acct_id)
+            pending.clear()
+            if unstarted:
+                invoke_accounts(unstarted, context, heartbeat)
 
-def main(account_id, org_name):
-    assumed_stsclient = ''
-    assumed_shclient = ''
-    assumed_emrclient = ''
+    executor.shutdown(wait=False, cancel_futures=True)
+    logger.info(f"Completed {len(summary['completed'])}, failed {len(summary['failed'])}, "
+                f"timed out {len(summary['timed_out'])}, excluded {len(summary['excluded'])}, "
+                f"handed to child invocations {len(summary['invoked'])} accounts")
+    return summary
 
+
+def main(account_id, org_name, db_items=None, heartbeat=False):
     ### // TEMP IF STATEMENT USED FOR TESTING - remove this IF statement later and shift tabs accordingly
     # if account_id == '663386616047' or account_id == '925130777241': # TEMP for testing
     ###
 
-    if account_id == hub_account:
-        # Hub (multitenant) account uses the local Lambda connection
-        assumed_stsclient = stsclient
-        assumed_shclient = shclient
-        assumed_emrclient = emrclient
-    else:
-        # Assume a role in the child account
-        assumed_session = assume_role(account_id, x_account_role)
-        assumed_stsclient = assumed_session.client('sts')
-        assumed_shclient = assumed_session.client('securityhub')
-        assumed_emrclient = assumed_session.client('emr')
-
+    # Hub (multitenant) account uses the local Lambda connection, other accounts use a cached assumed role session
+    with metrics.timer('Account.AssumeRole'):
+        account_session = get_account_session(account_id, x_account_role)
 
     # Sanity check to make sure the client connection context is in the correct account
-    assumed_account_id = assumed_stsclient.get_caller_identity()['Account']
+    assumed_account_id = account_session.account_id
     if assumed_account_id == account_id:
-        db_items = query_db_items(account_id, db_table, db_index)
-        clusters = get_clusters(assumed_emrclient)
-        logger.info(f'Begin processing {len(clusters)} clusters in the {org_name}/{account_id} account')
+        if db_items is None:
+            with metrics.timer('Account.QueryFindings'):
+                db_items = query_db_items(account_id, db_table, db_index)
+        scan_started = datetime.datetime.now(datetime.timezone.utc)
+        changed_since = db_items.checkpoint if scan_mode == 'incremental' and not heartbeat else None
+        logger.info(f'Begin processing clusters in {len(scan_regions)} regions in the {org_name}/{account_id} account (changed since: {changed_since})')
+
+        # Each region has its own EMR and Security Hub endpoints and rate limits, so regions are scanned concurrently
+        failed_regions = []
+        with ThreadPoolExecutor(max_workers=max(1, min(region_workers, len(scan_regions)))) as executor:
+            futures = {
+                executor.submit(
+                    scan_region, account_session, account_id, org_name, region, db_items, scan_started, changed_since, heartbeat
+                ): region
+                for region in scan_regions
+            }
+            for future in futures:
+                region = futures[future]
+                try:
+                    cluster_count = future.result()
+                    logger.info(f'Processed {cluster_count} clusters in {region} in the {org_name}/{account_id} account')
+                except Exception:
+                    logger.exception(f'Error processing {region} in the {org_name}/{account_id} account')
+                    failed_regions.append(region)
+
+        # Only advance the checkpoint when every region was scanned
+        if not failed_regions:
+            db_writer = DynamoDBBatchWriter(db_table)
+            write_checkpoint(db_writer, account_id, org_name, scan_started)
+            db_writer.flush()
+
+    else:
+        logger.error(f'The account ({account_id}) does not match the assumed account ({assumed_account_id})')
+
+    ###
+    ### // END TEMP IF STATEMENT USED FOR TESTING
+    ###
+    return (f'Function complete for {org_name}/{account_id}')
+
+
+def scan_region(account_session, account_id, org_name, region, db_items, scan_started, changed_since, heartbeat=False):
+    # Evaluate the clusters in one region of the account and return the number of clusters processed
+    assumed_shclient = account_session.client('securityhub', region)
+    assumed_emrclient = account_session.client('emr', region)
+    finding_buffer = FindingBuffer(assumed_shclient)
+    db_writer = DynamoDBBatchWriter(db_table)
+    created_after = scan_started - datetime.timedelta(days=cluster_lookback_days)
+    seen_cluster_arns = set()
+    clusters = get_clusters(assumed_emrclient, created_after, cluster_states, changed_since, seen_cluster_arns)
+    cluster_count = 0
+    unchanged_count = 0
+    snapshot_cache = {}
+    script_hashes = {}
+    row_writes = []  # (cluster ARN, write_to_dynamodb arguments), written once the findings are imported
+    archived_items = []
+
+    def script_hash(script_path):
+        # Only called when the rule set has script hash rules
+        if script_path not in script_hashes:
+            script_hashes[script_path] = get_script_sha256(account_session.client('s3', region), script_path)
+        return script_hashes[script_path]
+
+    try:
         for cluster in clusters:
+            cluster_count += 1
             cluster_id = cluster.get('Id', None)
-            cluster_arn = cluster.get('ClusterArn', None)
-            primary_tech_poc = None
-            secondary_tech_poc = None
-            matches = []
-            compliance_status = ''
-            bootstrap_scripts = get_cluster_bootstrap(cluster_id, assumed_emrclient)
-
-            for match in bootstrap_scripts:
-                if 's3://emr-boot-strap/' in match:
-                    matches.append(match)
-            if len(matches) > 0:
+            (db_item, db_item_found) = get_db_item(db_items, region_db_key(cluster_id, region))
+            with metrics.timer('Cluster.Snapshot'):
+                snapshot = get_cluster_snapshot(cluster, assumed_emrclient, snapshot_cache, db_item)
+            cluster_arn = snapshot.cluster_arn
+            primary_tech_poc = snapshot.primary_tech_poc
+            secondary_tech_poc = snapshot.secondary_tech_poc
+            tag_map = snapshot.tag_map
+            (compliance_status, rule_results) = bootstrap_rules.evaluate(snapshot.bootstrap_scripts, script_hash)
+            if compliance_status == 'PASSED':
                 compliance = 'COMPLIANT'
-                compliance_status = 'PASSED'
-                print(f'{cluster_id} is {compliance}')
             else:
                 compliance = 'NON_COMPLIANT'
-                compliance_status = 'FAILED'
-                print(f'{cluster_id} is {compliance}')
-
-            # Get Tags
-            try:
-                tags = assumed_emrclient.describe_cluster(ClusterId=cluster_id)['Cluster']['Tags']
-                if len(tags) > 0:
-                    for tag in tags:
-                        try:
-                            if tag['Key'] == 'PrimaryTechPOC':
-                                primary_tech_poc = tag['Value']
-                        except:
-                            pass
-                        try:
-                            if tag['Key'] == 'SecondaryTechPOC':
-                                secondary_tech_poc = tag['Value']
-                        except:
-                            pass
-            except:
-                tags = []
-                print('No tags present')
-                pass
-
-            tag_map = map_tags(tags)
+            print(f'{cluster_id} is {compliance}')
 
             sechub_action = ''
             finding_id = ''
-            db_item = ''
-            db_item_found = False
+            fingerprint = get_fingerprint(snapshot, compliance_status, rule_results)
             # Set the DynamoDB record TTL to 90 days in seconds (7776000)
             int_ttl = int(datetime.datetime.utcnow().timestamp()) + 7776000
 
-            (db_item, db_item_found) = get_db_item(db_items, cluster_id)
+            # Nothing changed since the last import, so leave the finding and the DynamoDB row alone
+            # unless this is a heartbeat run or the finding is due for a refresh
+            if db_item_found and not heartbeat and is_unchanged(db_item, fingerprint):
+                unchanged_count += 1
+                continue
 
             if db_item_found:
                 try:
@@ -186,74 +370,228 @@ def main(account_id, org_name):
                     # 'new' (new record), 'update' (update existing finding), 'archive' (archive because of compliance change or deletion)
                     sechub_action = 'update'
                     import_sechub_finding(
-                        assumed_shclient, cluster_arn, cluster_id, account_id, org_name, 
-                        compliance_status, sechub_action, finding_id, tag_map
+                        finding_buffer, cluster_arn, cluster_id, account_id, org_name, 
+                        compliance_status, sechub_action, finding_id, tag_map, region, rule_results
                     )
                 else:
                     # There is a compliance change, so archive the old finding ID, then create a new finding ID and update dynamoDB
                     sechub_action = 'archive'
                     import_sechub_finding(
-                        assumed_shclient, cluster_arn, cluster_id, account_id, org_name, 
-                        compliance_status, sechub_action, finding_id, tag_map
+                        finding_buffer, cluster_arn, cluster_id, account_id, org_name, 
+                        compliance_status, sechub_action, finding_id, tag_map, region, rule_results
                     )
                     finding_id = uuid.uuid1()
                     sechub_action = 'new'
                     import_sechub_finding(
-                        assumed_shclient, cluster_arn, cluster_id, account_id, org_name, 
-                        compliance_status, sechub_action, finding_id, tag_map
+                        finding_buffer, cluster_arn, cluster_id, account_id, org_name, 
+                        compliance_status, sechub_action, finding_id, tag_map, region, rule_results
                     )
             else:
                 # No existing role in dynamoDB, so create a new SecHub finding ID and new dynamoDB record
                 finding_id = uuid.uuid1()
                 sechub_action = 'new'
                 import_sechub_finding(
-                    assumed_shclient, cluster_arn, cluster_id, account_id, org_name, 
-                    compliance_status, sechub_action, finding_id, tag_map
+                    finding_buffer, cluster_arn, cluster_id, account_id, org_name, 
+                    compliance_status, sechub_action, finding_id, tag_map, region, rule_results
                 )
 
-            ### BEGIN NEW V2 CODE ###
-            retry_count = 0
-            retry = write_to_dynamodb(
-                cluster_arn, cluster_id, account_id, org_name, primary_tech_poc,
-                secondary_tech_poc, compliance_status, finding_id, int_ttl
+            row_writes.append((cluster_arn, (
+                db_writer, cluster_arn, cluster_id, account_id, org_name, primary_tech_poc,
+                secondary_tech_poc, compliance_status, finding_id, int_ttl, snapshot, region, fingerprint
+            )))
+
+        archived_items = archive_orphaned_clusters(finding_buffer, db_items, seen_cluster_arns, account_id, org_name, region, assumed_emrclient)
+    finally:
+        # Rows (and their fingerprints) are only written for clusters whose findings were all imported, and rows
+        # are only deleted once their finding is archived, so a failed import is retried by the next run
+        dropped_cluster_arns = finding_buffer.flush()
+        for cluster_arn, write_args in row_writes:
+            if cluster_arn not in dropped_cluster_arns:
+                write_to_dynamodb(*write_args)
+        for item in archived_items:
+            if item['Cluster Arn'] not in dropped_cluster_arns:
+                db_writer.delete({db_key: {'S': item[db_key]}})
+        db_writer.flush()
+    # Dropped findings or rows fail the region, so the account checkpoint is not advanced past them
+    if finding_buffer.dropped or db_writer.dropped:
+        raise Exception(f'Dropped {finding_buffer.dropped} Security Hub findings and {db_writer.dropped} DynamoDB rows in {region} in the {org_name}/{account_id} account')
+    logger.info(f'Skipped {unchanged_count} unchanged clusters in {region} in the {org_name}/{account_id} account')
+    logger.info(f'Consumed {db_writer.consumed_capacity} write capacity units on {db_table} for {org_name}/{account_id} in {region}')
+    return cluster_count
+
+
+def archive_orphaned_clusters(finding_buffer, db_items, seen_cluster_arns, account_id, org_name, region, emr_client):
+    # Clusters that are stored for this region but were not returned by list_clusters. The listing is filtered
+    # (CLUSTER_STATES, and CreatedAfter for terminated clusters), so each one is confirmed with describe_cluster
+    # and only archived when EMR no longer has it or it has terminated. Returns the archived items, whose rows
+    # the caller deletes once the archived findings are imported
+    orphans = [item for item in db_items.unseen(seen_cluster_arns) if item.get('Region', home_region) == region]
+    archived = []
+    for item in orphans:
+        cluster_arn = item['Cluster Arn']
+        cluster_id = cluster_arn.split('/')[-1]
+        if not is_cluster_gone(emr_client, cluster_id):
+            continue
+        archived.append(item)
+        if item.get('Finding ID'):
+            import_sechub_finding(
+                finding_buffer, cluster_arn, cluster_id, account_id, org_name,
+                item.get('Compliance Status', 'NOT_AVAILABLE'), 'archive', item['Finding ID'], {}, region
             )
-            while retry:
-                retry_count += 1
-                logger.info(f'Custom retry count: {retry_count} of {max_retries}')
-                if retry_count > max_retries:
-                    logger.error(f'Exceeded the number of custom retries writing to DynamoDB for resource {cluster_arn}. Try increasing the number of retries or the provisioned capacity for the table {db_table}')
-                    break
-                else:
-                    logger.info(f'Waiting {sleep_timer} seconds before retrying')
-                    time.sleep (sleep_timer)
-                    logger.info(f'Retrying write to DynamoDB for resource {cluster_arn}')
-                    retry = write_to_dynamodb(
-                        cluster_arn, cluster_id, account_id, org_name, primary_tech_poc,
-                        secondary_tech_poc, compliance_status, finding_id, int_ttl
-                    )
-            ### END NEW V2 CODE ###
+        drop_terminated_snapshot(cluster_id)
+    if orphans:
+        logger.info(f'Archived {len(archived)} of {len(orphans)} unlisted clusters in {region} in the {org_name}/{account_id} account')
+    return archived
+
+
+def is_cluster_gone(emr_client, cluster_id):
+    # True when EMR no longer returns the cluster or it has terminated, live clusters and errors keep their finding
+    try:
+        state = emr_client.describe_cluster(ClusterId=cluster_id)['Cluster']['Status']['State']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidRequestException':
+            return True
+        logger.warning(f"Unable to describe unlisted cluster {cluster_id}: {e.response['Error']['Code']}")
+        return False
+    return state in terminated_states
+
+
+def get_fingerprint(snapshot, compliance_status, rule_results=None):
+    # Hash of everything that ends up in the finding, used to skip imports when nothing changed
+    content = {
+        'Compliance': compliance_status,
+        'RuleVersion': f'{bootstrap_rules.rule_id}/{bootstrap_rules.version}',
+        'RuleResults': rule_results or {},
+        'Tags': snapshot.tag_map,
+        'PrimaryTechPOC': snapshot.primary_tech_poc,
+        'SecondaryTechPOC': snapshot.secondary_tech_poc,
+        'BootstrapScripts': sorted(snapshot.bootstrap_scripts),
+        # A cluster that terminates gets its row rewritten once, which stores the terminated snapshot
+        'Terminated': snapshot.terminated,
+    }
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def is_unchanged(db_item, fingerprint):
+    # The stored fingerprint matches and the finding was refreshed within heartbeat_days
+    if db_item.get('Fingerprint') != fingerprint:
+        return False
+    updated_at = int(db_item.get('Updated At', 0))
+    return updated_at >= int(datetime.datetime.utcnow().timestamp()) - heartbeat_days * 86400
+
 
+def region_db_key(cluster_id, region):
+    # Clusters in the Lambda's own region keep the plain cluster ID as the key so existing rows still match
+    if region == home_region:
+        return cluster_id
+    return f'{region}/{cluster_id}'
+
+
+class AccountSession:
+    # A boto3 session for one account with its clients built on first use
+    def __init__(self, session, account_id, expiration=None, clients=None):
+        self.session = session
+        self.account_id = account_id
+        self.expiration = expiration
+        self.clients = dict(clients or {})
+        self.lock = threading.Lock()
+
+    def expiring(self):
+        if self.expiration is None:
+            return False
+        remaining = self.expiration - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() < session_refresh_margin
+
+    def client(self, service_name, region_name=None):
+        key = (service_name, region_name or home_region)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = metrics.instrument(self.session.client(service_name, region_name=key[1]))
+            return self.clients[key]
+
+
+def get_account_session(account_id, role_name):
+    # Reuse the cached session for (account, role) until shortly before its credentials expire,
+    # so warm containers skip STS for accounts they have already seen
+    key = (account_id, role_name)
+    with account_sessions_lock:
+        account_session = account_sessions.get(key)
+    if account_session and not account_session.expiring():
+        return account_session
+
+    if account_id == hub_account:
+        account_session = AccountSession(
+            boto3.session.Session(), hub_account,
+            clients={
+                ('sts', home_region): stsclient,
+                ('securityhub', home_region): shclient,
+                ('emr', home_region): emrclient
+            }
+        )
     else:
-        logger.error(f'The account ({account_id}) does not match the assumed account ({assumed_account_id})')
+        role_arn = f'arn:aws:iam::{account_id}:role/{role_name}'
+        logger.info(f"Assuming IAM role '{role_name}' in account {account_id}")
+        response = stsclient.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=f'{role_name}_acct_{account_id}'[:64]
+        )
+        credentials = response['Credentials']
+        session = boto3.session.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken']
+        )
+        # arn:aws:sts::<account>:assumed-role/<role>/<session>
+        assumed_account_id = response['AssumedRoleUser']['Arn'].split(':')[4]
+        account_session = AccountSession(session, assumed_account_id, credentials['Expiration'])
 
-    ###
-    ### // END TEMP IF STATEMENT USED FOR TESTING
-    ###
-    return (f'Function complete for {org_name}/{account_id}')
+    with account_sessions_lock:
+        account_sessions[key] = account_session
+    return account_session
 
 
 def get_account_list():
-    # Scan Table for Active OU Accounts
-    response = dbclient.scan(
-        TableName='org-Organizations-OUAccountsTable-Table',
-        ExpressionAttributeNames={"#St": "Status", "#Us": "Usage"},
-        FilterExpression="#St = :x AND #Us = :y",
-        ExpressionAttributeValues={":x": {"S": "ACTIVE"}, ":y": {"S": "Standard"}}
-    )
-    accts = response['Items']
+    # Active Standard OU accounts, cached at module level for account_list_ttl seconds so warm containers reuse it
+    global account_list_cache, account_list_loaded
+    if account_list_cache is not None and time.monotonic() - account_list_loaded < account_list_ttl:
+        return account_list_cache
+
+    if accounts_index:
+        # Query the Status/Usage GSI instead of scanning a large table
+        paginator = dbclient.get_paginator('query')
+        response_iterator = paginator.paginate(
+            TableName=accounts_table,
+            IndexName=accounts_index,
+            ExpressionAttributeNames={"#St": "Status", "#Us": "Usage"},
+            KeyConditionExpression="#St = :x AND #Us = :y",
+            ExpressionAttributeValues={":x": {"S": "ACTIVE"}, ":y": {"S": "Standard"}}
+        )
+    else:
+        # Scan Table for Active OU Accounts
+        paginator = dbclient.get_paginator('scan')
+        response_iterator = paginator.paginate(
+            TableName=accounts_table,
+            ExpressionAttributeNames={"#St": "Status", "#Us": "Usage"},
+            FilterExpression="#St = :x AND #Us = :y",
+            ExpressionAttributeValues={":x": {"S": "ACTIVE"}, ":y": {"S": "Standard"}}
+        )
+    accts = []
+    for response in response_iterator:
+        accts.extend(response['Items'])
+
+    account_list_cache = accts
+    account_list_loaded = time.monotonic()
     return accts
 
 
+def get_dbresource():
+    if threading.current_thread() is threading.main_thread():
+        return dbresource
+    if not hasattr(thread_local, 'dbresource'):
+        thread_local.dbresource = metrics.instrument(boto3.session.Session().resource('dynamodb'))
+    return thread_local.dbresource
+
+
 def get_org_name(account_id, accts):
     # Lookup the org name for the account ID
     for acct in accts:
@@ -263,21 +601,41 @@ def get_org_name(account_id, accts):
 
 def query_db_items(account_id, db_table, db_index):
     # Query Table for existing findings
-    table = dbresource.Table(db_table)
-    query_response = table.query(
-        TableName=db_table,
-        IndexName=db_index,
-        Select='ALL_ATTRIBUTES',
-        KeyConditionExpression=Key('Account ID').eq(account_id)
-    )
-    count = query_response['Count']
-    scanned_count = query_response['ScannedCount']
-    if count == scanned_count:
-        db_items = query_response['Items']
-        return db_items
+    db_items = DBItemIndex()
+    for items in iter_db_item_pages(account_id, db_table, db_index):
+        for item in items:
+            db_items.add(item)
+    return db_items
+
+
+def iter_db_item_pages(account_id, db_table, db_index, projection=db_projection):
+    # Stream the account's findings one page at a time, following LastEvaluatedKey.
+    # Only the attributes in 'projection' are read (all attributes if it is empty).
+    table = get_dbresource().Table(db_table)
+    params = {
+        'IndexName': db_index,
+        'KeyConditionExpression': Key('Account ID').eq(account_id)
+    }
+    if projection:
+        # Attribute names contain spaces, so they all go through ExpressionAttributeNames
+        names = {f'#p{i}': name for i, name in enumerate(projection)}
+        params['ProjectionExpression'] = ', '.join(names)
+        params['ExpressionAttributeNames'] = names
     else:
-        raise Exception(
-            f'Query count ({count}) and scanned count ({scanned_count}) do not match. Some DB items may be missing from the query result.')
+        params['Select'] = 'ALL_ATTRIBUTES'
+    while True:
+        query_response = table.query(**params)
+        yield query_response['Items']
+        if 'LastEvaluatedKey' not in query_response:
+            break
+        params['ExclusiveStartKey'] = query_response['LastEvaluatedKey']
+
+
+def query_db_items_for_accounts(account_ids, db_table, db_index):
+    # Query several accounts' findings concurrently, returns a DBItemIndex per account ID
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(account_ids)))) as executor:
+        results = executor.map(lambda acct_id: query_db_items(acct_id, db_table, db_index), account_ids)
+        return dict(zip(account_ids, results))
 
 
 def map_tags(tags):
@@ -292,10 +650,159 @@ def map_tags(tags):
     return tag_map
 
 
-def get_clusters(emr_client):
-    response = emr_client.list_clusters()
-    clusters = response['Clusters']
-    return clusters
+def get_clusters(emr_client, created_after=None, cluster_states=None, changed_since=None, seen_cluster_arns=None):
+    # Stream clusters from the list_clusters paginator. Active clusters are listed without CreatedAfter so
+    # long-running clusters are always evaluated, created_after only limits the terminated clusters. If
+    # changed_since is set, only clusters whose creation, ready or end time is on or after that time are
+    # yielded. Every listed cluster's ARN, including the ones filtered out, is added to seen_cluster_arns.
+    states = cluster_states or active_states + terminated_states
+    listings = []
+    active = [state for state in states if state not in terminated_states]
+    if active:
+        listings.append({'ClusterStates': active})
+    terminated = [state for state in states if state in terminated_states]
+    if terminated:
+        # Listed after the active clusters, a cluster that terminates in between shows up in both listings
+        # rather than in neither
+        params = {'ClusterStates': terminated}
+        if created_after:
+            params['CreatedAfter'] = created_after
+        listings.append(params)
+
+    listed = set()
+    paginator = emr_client.get_paginator('list_clusters')
+    for params in listings:
+        for page in paginator.paginate(**params):
+            for cluster in page['Clusters']:
+                cluster_arn = cluster.get('ClusterArn')
+                if cluster_arn in listed:
+                    continue
+                listed.add(cluster_arn)
+                if seen_cluster_arns is not None:
+                    seen_cluster_arns.add(cluster_arn)
+                if changed_since:
+                    timeline = cluster.get('Status', {}).get('Timeline', {})
+                    last_change = max(timeline.values(), default=None)
+                    if last_change and last_change < changed_since:
+                        continue
+                yield cluster
+
+
+def write_checkpoint(db_writer, account_id, org_name, scan_started):
+    # The last successful scan time is stored as its own row in the findings table so it is
+    # returned by the same account query as the findings
+    db_writer.put({
+        db_key: {
+            'S': f'{checkpoint_prefix}{account_id}',
+        },
+        'Account ID': {
+            'S': account_id,
+        },
+        'Account Name': {
+            'S': org_name,
+        },
+        'Last Scan': {
+            'N': str(int(scan_started.timestamp())),
+        },
+    })
+
+
+class PrefixTrie:
+    # Character trie of approved prefixes, a lookup costs one step per character of the path
+    # no matter how many prefixes are approved
+    def __init__(self, prefixes=()):
+        self.root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node[None] = prefix
+
+    def match(self, path):
+        # Returns the shortest approved prefix of path, or None. An empty approved prefix matches every path
+        # and is returned as '', so callers test the result against None
+        node = self.root
+        for ch in path:
+            if None in node:
+                return node[None]
+            node = node.get(ch)
+            if node is None:
+                return None
+        return node.get(None)
+
+
+class BootstrapRuleSet:
+    # Compiled approved-bootstrap rules. A cluster is PASSED when every rule passes:
+    #   allowed_prefixes - at least one bootstrap script starts with an approved prefix
+    #   script_hashes    - at least one bootstrap script's content SHA-256 (hex) is in the approved list
+    #   required_scripts - every listed script path is among the bootstrap scripts
+    def __init__(self, config):
+        self.rule_id = config.get('rule_id', 'org-EMR-2')
+        self.version = str(config.get('version', '1.0'))
+        self.rules = []
+        for rule in config.get('rules', []):
+            rule_type = rule['type']
+            if rule_type == 'allowed_prefixes':
+                compiled = PrefixTrie(rule['prefixes'])
+            elif rule_type == 'script_hashes':
+                compiled = set(h.lower() for h in rule['hashes'])
+            elif rule_type == 'required_scripts':
+                compiled = set(rule['scripts'])
+            else:
+                raise Exception(f'Unknown bootstrap rule type: {rule_type}')
+            self.rules.append((rule.get('name', rule_type), rule_type, compiled))
+
+    def evaluate(self, script_paths, script_hash=None):
+        # Returns (compliance_status, {rule name: 'PASSED' | 'FAILED'})
+        rule_results = {}
+        for name, rule_type, compiled in self.rules:
+            if rule_type == 'allowed_prefixes':
+                passed = any(compiled.match(path) is not None for path in script_paths)
+            elif rule_type == 'script_hashes':
+                passed = script_hash is not None and any(script_hash(path) in compiled for path in script_paths)
+            else:
+                passed = compiled.issubset(script_paths)
+            rule_results[name] = 'PASSED' if passed else 'FAILED'
+        passed = rule_results and all(result == 'PASSED' for result in rule_results.values())
+        compliance_status = 'PASSED' if passed else 'FAILED'
+        return (compliance_status, rule_results)
+
+
+def load_bootstrap_rules():
+    # Rules come from the JSON file named by BOOTSTRAP_RULES_FILE, the BOOTSTRAP_RULES environment variable,
+    # or default to the original check for scripts under s3://emr-boot-strap/
+    rules_file = os.environ.get('BOOTSTRAP_RULES_FILE')
+    if rules_file:
+        with open(rules_file) as f:
+            return BootstrapRuleSet(json.load(f))
+    if os.environ.get('BOOTSTRAP_RULES'):
+        return BootstrapRuleSet(json.loads(os.environ['BOOTSTRAP_RULES']))
+    return BootstrapRuleSet({
+        'rules': [{'name': 'approved-prefix', 'type': 'allowed_prefixes', 'prefixes': ['s3://emr-boot-strap/']}]
+    })
+
+
+bootstrap_rules = load_bootstrap_rules()  # compiled once per container
+
+
+def get_script_sha256(s3_client, script_path):
+    # Hex SHA-256 of the content of an s3:// bootstrap script, or None if it is not in S3 or cannot be read.
+    # The object is read rather than using its ETag, which is not a content hash for multipart uploads or
+    # SSE-KMS objects
+    if not script_path.startswith('s3://'):
+        return None
+    bucket, _, key = script_path[len('s3://'):].partition('/')
+    try:
+        digest = hashlib.sha256()
+        for chunk in s3_client.get_object(Bucket=bucket, Key=key)['Body'].iter_chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+    except ClientError as e:
+        logger.warning(f"Unable to read {script_path}: {e.response['Error']['Code']}")
+        return None
 
 
 def get_cluster_bootstrap(cluster_id, emr_client):
@@ -310,21 +817,132 @@ def get_cluster_bootstrap(cluster_id, emr_client):
     return script_paths
 
 
+class ClusterSnapshot:
+    # Everything main() needs from EMR for a cluster, fetched once per run. A snapshot whose describe_cluster
+    # call failed has no tags and is not complete, so it is never reused by later runs
+    def __init__(self, cluster_id, cluster_arn, state, bootstrap_scripts, tag_map, complete=True):
+        self.cluster_id = cluster_id
+        self.cluster_arn = cluster_arn
+        self.state = state
+        self.bootstrap_scripts = bootstrap_scripts
+        self.tag_map = tag_map
+        self.primary_tech_poc = tag_map.get('PrimaryTechPOC')
+        self.secondary_tech_poc = tag_map.get('SecondaryTechPOC')
+        self.complete = complete
+
+    @property
+    def terminated(self):
+        return self.state in terminated_states
+
+    def to_json(self):
+        return json.dumps({
+            'ClusterId': self.cluster_id,
+            'ClusterArn': self.cluster_arn,
+            'State': self.state,
+            'BootstrapScripts': self.bootstrap_scripts,
+            'Tags': self.tag_map,
+        })
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        return cls(data['ClusterId'], data['ClusterArn'], data['State'], data['BootstrapScripts'], data['Tags'])
+
+
+def get_cluster_snapshot(cluster, emr_client, snapshot_cache, db_item=''):
+    # Lookup order: this run's cache, the container-wide cache and the findings table (terminated clusters only),
+    # then one list_bootstrap_actions and one describe_cluster call
+    cluster_id = cluster.get('Id', None)
+    state = cluster.get('Status', {}).get('State')
+    if cluster_id in snapshot_cache:
+        return snapshot_cache[cluster_id]
+
+    snapshot = None
+    if state in terminated_states:
+        snapshot = get_terminated_snapshot(cluster_id)
+        if not snapshot and db_item and db_item.get('Snapshot'):
+            try:
+                snapshot = ClusterSnapshot.from_json(db_item['Snapshot'])
+            except Exception:
+                logger.exception(f'Error reading the stored snapshot for cluster: {cluster_id}')
+        if snapshot and not snapshot.terminated:
+            # The stored snapshot was taken while the cluster was still running
+            snapshot = None
+
+    if not snapshot:
+        bootstrap_scripts = get_cluster_bootstrap(cluster_id, emr_client)
+        cluster_arn = cluster.get('ClusterArn', None)
+        complete = True
+        try:
+            description = emr_client.describe_cluster(ClusterId=cluster_id)['Cluster']
+            tags = description.get('Tags', [])
+            cluster_arn = description.get('ClusterArn', cluster_arn)
+            state = description.get('Status', {}).get('State', state)
+        except Exception as e:
+            tags = []
+            complete = False
+            logger.warning(f'Unable to describe cluster {cluster_id}, evaluating it without tags: {e}')
+        snapshot = ClusterSnapshot(cluster_id, cluster_arn, state, bootstrap_scripts, map_tags(tags), complete)
+
+    snapshot_cache[cluster_id] = snapshot
+    if snapshot.terminated and snapshot.complete:
+        put_terminated_snapshot(cluster_id, snapshot)
+    return snapshot
+
+
+def get_terminated_snapshot(cluster_id):
+    with terminated_snapshots_lock:
+        snapshot = terminated_snapshots.get(cluster_id)
+        if snapshot:
+            terminated_snapshots.move_to_end(cluster_id)
+        return snapshot
+
+
+def put_terminated_snapshot(cluster_id, snapshot):
+    with terminated_snapshots_lock:
+        terminated_snapshots[cluster_id] = snapshot
+        terminated_snapshots.move_to_end(cluster_id)
+        while len(terminated_snapshots) > snapshot_cache_size:
+            terminated_snapshots.popitem(last=False)
+
+
+def drop_terminated_snapshot(cluster_id):
+    with terminated_snapshots_lock:
+        terminated_snapshots.pop(cluster_id, None)
+
+
 def get_db_item(db_items, id):
-    db_item_found = False
-    db_item = ''
-    for db_item in db_items:
-        db_id = db_item[db_key]
-        if db_id == id:
-            db_item_found = True
-            return (db_item, db_item_found)
-    db_item = ''
+    db_item = db_items.get(id, '')
+    db_item_found = db_item != ''
     return (db_item, db_item_found)
 
 
+class DBItemIndex(dict):
+    # Findings table items keyed on db_key (cluster ID), with a secondary index on 'Cluster Arn'
+    def __init__(self, items=()):
+        super().__init__()
+        self.by_arn = {}
+        self.checkpoint = None  # time of the last successful scan of the account
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        if str(item[db_key]).startswith(checkpoint_prefix):
+            self.checkpoint = datetime.datetime.fromtimestamp(int(item['Last Scan']), datetime.timezone.utc)
+            return
+        self[item[db_key]] = item
+        cluster_arn = item.get('Cluster Arn')
+        if cluster_arn:
+            self.by_arn[cluster_arn] = item
+
+    def unseen(self, seen_cluster_arns):
+        # Items for clusters that are in DynamoDB but were not returned by EMR in this run
+        return [item for cluster_arn, item in self.by_arn.items() if cluster_arn not in seen_cluster_arns]
+
+
 def import_sechub_finding(
-        assumed_shclient, cluster_arn, cluster_id, account_id, org_name, 
-        compliance_status, sechub_action, finding_id, tag_map
+        finding_buffer, cluster_arn, cluster_id, account_id, org_name, 
+        compliance_status, sechub_action, finding_id, tag_map, region=None, rule_results=None
 ):
     #########################################################
     # Possible values for the 'sechub_action' parameter
@@ -334,9 +952,9 @@ def import_sechub_finding(
     #########################################################
 
     lambda_name = os.environ['AWS_LAMBDA_FUNCTION_NAME']
-    region = os.environ['AWS_REGION']
-    rule_id = 'org-EMR-2'
-    version = '1.0'
+    region = region or home_region
+    rule_id = bootstrap_rules.rule_id
+    version = bootstrap_rules.version
     company_name = 'org'
     d = datetime.datetime.utcnow()
     sh_date_created = d.replace(tzinfo=datetime.timezone.utc).isoformat()  # only used if SecHub imports a new record
@@ -435,50 +1053,227 @@ def import_sechub_finding(
     if not tag_map:
         del findings[0]['Resources'][0]['Tags']
 
-    try:
-        import_response = assumed_shclient.batch_import_findings(
-            Findings=findings
-        )
-        # logger.debug('Response from import finding:')
-        # logger.debug(import_response)
-        if import_response['FailedCount'] != 0:
-            failed_findings = import_response['FailedFindings'][0]
-            logger.error(f'Error importing finding: {id}')
-            logger.error(failed_findings)
-            logger.error(f'The error occurred for EMR Cluster: {cluster_arn}')
-            logger.error(f'The finding data that failed to import is below:')
-            logger.error(findings)
+    for rule_name, rule_result in (rule_results or {}).items():
+        findings[0]['ProductFields'][f'org/custom/rule/{rule_name}'] = rule_result
 
-    except ClientError as e:
-        # The RateLimit = 10/s and BurstLimit = 30/s
-        # For now, let's log the issue and determine if we need to reprocess or wait until the next invocation.
-        # If we add retry logic, we need to make sure we don't enter an infinite loop of retries
-        # by counting and setting a max number of retries and/or by doing a bulk import of findings
-        logger.exception(f'ClientError: {e}')
-        logger.error(f'The error occurred for EMR Cluster: {cluster_arn}')
-        logger.error(f'The finding data that failed to import is below:')
-        logger.error(findings)
-    except Exception as x:
-        logger.exception(f'Exception: {x}')
-        logger.error(f'The error occurred for EMR Cluster: {cluster_arn}')
-        logger.error(f'The finding data that failed to import is below:')
-        logger.error(findings)
+    finding_buffer.add(findings[0])
 
     return {
         'statusCode': 200,
     }
 
 
+class Metrics:
+    # Per-operation latency, call, retry and throttle metrics for one invocation, published as CloudWatch
+    # Embedded Metric Format log lines so no PutMetricData calls are needed. boto3 clients passed to
+    # instrument() are timed through botocore's before-call/after-call events, and every attempt (including
+    # the ones the SDK retries) is checked for throttling errors through the needs-retry event.
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.counters = collections.defaultdict(collections.Counter)
+
+    def add(self, operation, name, value=1):
+        with self.lock:
+            self.counters[operation][name] += value
+
+    def add_latency(self, operation, milliseconds):
+        with self.lock:
+            self.latencies[operation].append(round(milliseconds, 1))
+            self.counters[operation]['Calls'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, operation):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_latency(operation, (time.monotonic() - start) * 1000)
+
+    def instrument(self, client):
+        # Accepts a client or a resource, returns it unchanged
+        meta = getattr(client, 'meta', None)
+        if meta is not None and hasattr(meta, 'client'):
+            meta = meta.client.meta
+        events = getattr(meta, 'events', None)
+        if events is not None:
+            events.register('before-call', self.before_call)
+            events.register('after-call', self.after_call)
+            # The retry handler is registered on the service's needs-retry event and stops the event once it
+            # decides to retry, so this handler has to be registered first on the same event to see every attempt
+            events.register_first(f'needs-retry.{meta.service_model.service_id.hyphenize()}', self.needs_retry)
+        return client
+
+    def before_call(self, context=None, **kwargs):
+        if context is not None:
+            context['metrics_start'] = time.monotonic()
+
+    def after_call(self, parsed=None, model=None, context=None, **kwargs):
+        operation = f'{model.service_model.service_id}.{model.name}'.replace(' ', '')
+        start = (context or {}).get('metrics_start')
+        if start is not None:
+            self.add_latency(operation, (time.monotonic() - start) * 1000)
+        else:
+            self.add(operation, 'Calls')
+        parsed = parsed or {}
+        retry_attempts = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retry_attempts:
+            self.add(operation, 'Retries', retry_attempts)
+
+    def needs_retry(self, response=None, operation=None, **kwargs):
+        # Called for each attempt, returns None so the retry decision is left to botocore
+        if response is None or operation is None:
+            return None
+        if response[1].get('Error', {}).get('Code') in throttle_error_codes:
+            self.add(f'{operation.service_model.service_id}.{operation.name}'.replace(' ', ''), 'Throttles')
+        return None
+
+    def flush(self):
+        # One EMF document per operation (the Operation dimension) and per 100 latency values
+        with self.lock:
+            latencies, self.latencies = self.latencies, collections.defaultdict(list)
+            counters, self.counters = self.counters, collections.defaultdict(collections.Counter)
+        function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', '')
+        for operation in sorted(set(latencies) | set(counters)):
+            values = latencies.get(operation, [])
+            chunks = [values[i:i + 100] for i in range(0, len(values), 100)] or [[]]
+            for i, chunk in enumerate(chunks):
+                doc = {
+                    '_aws': {
+                        'Timestamp': int(time.time() * 1000),
+                        'CloudWatchMetrics': [{
+                            'Namespace': self.namespace,
+                            'Dimensions': [['FunctionName', 'Operation']],
+                            'Metrics': [],
+                        }],
+                    },
+                    'FunctionName': function_name,
+                    'Operation': operation,
+                }
+                definitions = doc['_aws']['CloudWatchMetrics'][0]['Metrics']
+                if chunk:
+                    definitions.append({'Name': 'Latency', 'Unit': 'Milliseconds'})
+                    doc['Latency'] = chunk
+                if i == 0:
+                    # Counts are only published once per operation
+                    for name, value in sorted(counters.get(operation, {}).items()):
+                        definitions.append({'Name': name, 'Unit': 'Count'})
+                        doc[name] = value
+                if definitions:
+                    print(json.dumps(doc))
+
+
+metrics = Metrics(metrics_namespace)
+for client in (stsclient, shclient, dbclient, dbresource, lambdaclient, emrclient):
+    metrics.instrument(client)
+
+
+class TokenBucket:
+    # Blocks callers so that requests stay within a steady rate while allowing short bursts
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class FindingBuffer:
+    # Collects Security Hub findings for an account and imports them in batches of up to 100,
+    # paced by a token bucket. Findings that fail are requeued individually up to sechub_max_retries times,
+    # flush() returns the ARNs of the clusters with a finding that was dropped after that.
+    def __init__(self, assumed_shclient, batch_size=sechub_batch_size):
+        self.shclient = assumed_shclient
+        self.batch_size = batch_size
+        self.bucket = TokenBucket(sechub_rate_limit, sechub_burst_limit)
+        self.queue = []  # list of (finding, attempt)
+        self.import_calls = 0
+        self.imported = 0
+        self.dropped = 0
+        self.dropped_cluster_arns = set()
+
+    def add(self, finding):
+        self.queue.append((finding, 0))
+        if len(self.queue) >= self.batch_size:
+            self.send_batch()
+
+    def flush(self):
+        while self.queue:
+            self.send_batch()
+        logger.info(f'Imported {self.imported} Security Hub findings in {self.import_calls} calls ({self.dropped} dropped)')
+        return self.dropped_cluster_arns
+
+    def send_batch(self):
+        batch = self.queue[:self.batch_size]
+        del self.queue[:self.batch_size]
+        with metrics.timer('SecurityHub.RateLimitWait'):
+            self.bucket.acquire()
+        self.import_calls += 1
+        try:
+            import_response = self.shclient.batch_import_findings(
+                Findings=[finding for finding, attempt in batch]
+            )
+        except ClientError as e:
+            logger.warning(f"ClientError importing {len(batch)} findings: {e.response['Error']['Code']}")
+            for finding, attempt in batch:
+                self.requeue(finding, attempt, e.response['Error'])
+            return
+        except Exception as x:
+            logger.exception(f'Exception: {x}')
+            for finding, attempt in batch:
+                self.requeue(finding, attempt, str(x))
+            return
+
+        failed = {}
+        if import_response['FailedCount'] != 0:
+            failed = {f['Id']: f for f in import_response['FailedFindings']}
+        for finding, attempt in batch:
+            if finding['Id'] in failed:
+                self.requeue(finding, attempt, failed[finding['Id']])
+            else:
+                self.imported += 1
+
+    def requeue(self, finding, attempt, error):
+        if attempt + 1 < sechub_max_retries:
+            metrics.add('SecurityHub.BatchImportFindings', 'Requeued')
+            self.queue.append((finding, attempt + 1))
+        else:
+            metrics.add('SecurityHub.BatchImportFindings', 'Dropped')
+            self.dropped += 1
+            self.dropped_cluster_arns.add(finding['Resources'][0]['Id'])
+            logger.error(f"Error importing finding: {finding['Id']}")
+            logger.error(error)
+            logger.error(f"The error occurred for EMR Cluster: {finding['Resources'][0]['Id']}")
+            logger.error(f'The finding data that failed to import is below:')
+            logger.error(finding)
+
+
 def write_to_dynamodb(
-        cluster_arn, cluster_id, account_id, org_name, primary_tech_poc,
-        secondary_tech_poc, compliance_status, finding_id, int_ttl
+        db_writer, cluster_arn, cluster_id, account_id, org_name, primary_tech_poc,
+        secondary_tech_poc, compliance_status, finding_id, int_ttl, snapshot=None, region=None, fingerprint=None
 ):
+    region = region or home_region
     db_item = {
         'Cluster Arn': {
             'S': cluster_arn,
         },
         db_key: {
-            'S': cluster_id,
+            'S': region_db_key(cluster_id, region),
+        },
+        'Region': {
+            'S': region,
         },
         'Account ID': {
             'S': account_id,
@@ -501,42 +1296,91 @@ def write_to_dynamodb(
         'TTL': {
             'N': str(int_ttl),
         },
+        'Updated At': {
+            'N': str(int(datetime.datetime.utcnow().timestamp())),
+        },
     }
+    if fingerprint:
+        db_item['Fingerprint'] = {
+            'S': fingerprint,
+        }
+    if snapshot and snapshot.terminated and snapshot.complete:
+        # Terminated clusters never change, so keep their snapshot for later runs
+        db_item['Snapshot'] = {
+            'S': snapshot.to_json(),
+        }
+    db_writer.put(db_item)
 
-    try:
-        dynamo_response = dbclient.put_item(
-            Item=db_item,
-            ReturnConsumedCapacity='TOTAL',
-            TableName=db_table,
-        )
-        ### BEGIN NEW V2 CODE ###
-        retry = False
-        retry_attempts = dynamo_response['ResponseMetadata']['RetryAttempts']
-        if (float(retry_attempts) / float(max_retries) * 100) >= 75:
-            # If the retry attempt finishes within 75% of the max retries, throw a warning and consider
-            # increasing the max_retries threshold or increase the provisioned capacity of the table
-            logger.warning(f'Auto-retry attempts reached {retry_attempts} of {max_retries} max for {cluster_arn}')
-        http_status_code = dynamo_response['ResponseMetadata']['HTTPStatusCode']
-        if http_status_code == 200:
-            return retry
-        else:
-            logger.error(f'Error (HTTP Status Code: {http_status_code}) writing to DynamoDB for resource: {cluster_arn}')
-            logger.error(db_item)
-            return retry
-    except ClientError as e:
-        error_code = e.response['Error']['Code']
-        if error_code == 'ProvisionedThroughputExceededException':
-            logger.warning(f'{error_code} writing to DynamoDB for resource {cluster_arn}. Entering custom retry pattern.')
-            retry = True
-            return retry
-        else:
-            logger.error(f'Unhandled client error writing the following record to DynamoDB for resource {cluster_arn}: {e}')
-            logger.error(db_item)
-            retry = False
-            return retry
-    except Exception as x:
-        logger.exception(f'Unhandled exception writing the following record to DynamoDB for resource {cluster_arn}: {x}')
-        logger.error(db_item)
-        retry = False
-        return retry
-        ### END NEW V2 CODE ###
+
+class DynamoDBBatchWriter:
+    # Groups item writes into 25-item BatchWriteItem requests. UnprocessedItems are resubmitted with
+    # jittered exponential backoff up to max_retries times, and consumed capacity is totalled for reporting.
+    # Items that still could not be written are counted in dropped.
+    def __init__(self, table_name, batch_size=25):
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.requests = []
+        self.consumed_capacity = 0.0
+        self.dropped = 0
+
+    def put(self, db_item):
+        self.requests.append({'PutRequest': {'Item': db_item}})
+        if len(self.requests) >= self.batch_size:
+            self.send_batch()
+
+    def delete(self, key):
+        self.requests.append({'DeleteRequest': {'Key': key}})
+        if len(self.requests) >= self.batch_size:
+            self.send_batch()
+
+    def flush(self):
+        while self.requests:
+            self.send_batch()
+
+    def send_batch(self):
+        batch = self.requests[:self.batch_size]
+        del self.requests[:self.batch_size]
+        retry_count = 0
+        while batch:
+            try:
+                dynamo_response = dbclient.batch_write_item(
+                    RequestItems={self.table_name: batch},
+                    ReturnConsumedCapacity='TOTAL',
+                )
+            except ClientError as e:
+                error_code = e.response['Error']['Code']
+                if error_code != 'ProvisionedThroughputExceededException':
+                    logger.error(f'Unhandled client error writing {len(batch)} records to DynamoDB: {e}')
+                    logger.error(batch)
+                    self.dropped += len(batch)
+                    return
+                logger.warning(f'{error_code} writing to DynamoDB. Entering custom retry pattern.')
+            except Exception as x:
+                logger.exception(f'Unhandled exception writing {len(batch)} records to DynamoDB: {x}')
+                logger.error(batch)
+                self.dropped += len(batch)
+                return
+            else:
+                retry_attempts = dynamo_response['ResponseMetadata']['RetryAttempts']
+                if (float(retry_attempts) / float(max_retries) * 100) >= 75:
+                    # If the retry attempt finishes within 75% of the max retries, throw a warning and consider
+                    # increasing the max_retries threshold or increase the provisioned capacity of the table
+                    logger.warning(f'Auto-retry attempts reached {retry_attempts} of {max_retries} max writing to {self.table_name}')
+                for capacity in dynamo_response.get('ConsumedCapacity', []):
+                    self.consumed_capacity += capacity.get('CapacityUnits', 0)
+                batch = dynamo_response.get('UnprocessedItems', {}).get(self.table_name, [])
+                if not batch:
+                    return
+                metrics.add('DynamoDB.BatchWriteItem', 'UnprocessedItems', len(batch))
+
+            retry_count += 1
+            metrics.add('DynamoDB.BatchWriteItem', 'CustomRetries')
+            if retry_count > max_retries:
+                logger.error(f'Exceeded the number of custom retries writing {len(batch)} records to DynamoDB. Try increasing the number of retries or the provisioned capacity for the table {self.table_name}')
+                logger.error(batch)
+                self.dropped += len(batch)
+                return
+            # Full jitter exponential backoff
+            delay = random.uniform(0, min(backoff_cap, backoff_base * 2 ** retry_count))
+            logger.info(f'Custom retry count: {retry_count} of {max_retries}, waiting {delay:.2f} seconds before retrying {len(batch)} records')
+            time.sleep(delay)
@@ -0,0 +1,447 @@
+#
+# Local benchmark for EMR-ApprovedBootstrapScript.py
+#
+# Runs lambda_handler against in-memory stand-ins for STS, EMR, Security Hub, DynamoDB, S3 and Lambda
+# with a synthetic org, then reports API calls per service, wall time, peak memory and throttling.
+# In invoke mode the queued child invocations are run after the orchestrator, one after another, and
+# counted in the same run. Nothing is sent to AWS. boto3/botocore must be installed since the Lambda imports them.
+#
+# Example:
+#   python benchmark.py --accounts 500 --clusters 200 --runs 2 --throttle 0.05
+#
+import argparse
+import collections
+import contextlib
+import datetime
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+
+import boto3
+from botocore.exceptions import ClientError
+
+HUB_ACCOUNT = '000000000000'
+HOME_REGION = 'us-east-1'
+LAMBDA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'EMR-ApprovedBootstrapScript.py')
+
+
+class Stats:
+    # Thread safe API call and throttle counters
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.throttles = collections.Counter()
+
+    def call(self, service, operation):
+        with self.lock:
+            self.calls[(service, operation)] += 1
+
+    def throttle(self, service, operation, count=1):
+        with self.lock:
+            self.throttles[(service, operation)] += count
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttles.clear()
+
+
+class SyntheticOrg:
+    # Accounts and clusters generated up front so every run sees the same fleet
+    def __init__(self, accounts, clusters, regions, compliant_ratio, seed):
+        rng = random.Random(seed)
+        self.accounts = [f'{100000000000 + i}' for i in range(accounts)]
+        self.clusters = {}  # (account, region) -> list of cluster dicts
+        self.by_id = {}
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for account in self.accounts:
+            for region in regions:
+                fleet = []
+                for i in range(clusters):
+                    cluster_id = f'j-{account[-6:]}{region[-1]}{i:06d}'
+                    terminated = rng.random() < 0.5
+                    scripts = [f's3://team-bucket/{cluster_id}/setup.sh']
+                    if rng.random() < compliant_ratio:
+                        scripts.append('s3://emr-boot-strap/harden.sh')
+                    # Some clusters are older than the 60 day default lookback, long-running active ones must
+                    # still be evaluated and keep their findings
+                    created = now - datetime.timedelta(days=rng.randint(1, 50) if rng.random() < 0.8 else rng.randint(61, 400))
+                    timeline = {'CreationDateTime': created}
+                    if terminated:
+                        timeline['EndDateTime'] = created + datetime.timedelta(hours=rng.randint(1, 48))
+                    fleet.append({
+                        'Id': cluster_id,
+                        'Name': cluster_id,
+                        'ClusterArn': f'arn:aws:elasticmapreduce:{region}:{account}:cluster/{cluster_id}',
+                        'Status': {
+                            'State': 'TERMINATED' if terminated else 'WAITING',
+                            'Timeline': timeline,
+                        },
+                        'BootstrapScripts': scripts,
+                        'Tags': [
+                            {'Key': 'PrimaryTechPOC', 'Value': f'owner{i % 7}@example.com'},
+                            {'Key': 'SecondaryTechPOC', 'Value': f'backup{i % 5}@example.com'},
+                        ],
+                    })
+                self.clusters[(account, region)] = fleet
+                self.by_id.update((cluster['Id'], cluster) for cluster in fleet)
+
+
+class FakePaginator:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages(**kwargs)
+
+
+class FakeClient:
+    # Base for the service stand-ins, counts every call and optionally adds latency
+    service = ''
+
+    def __init__(self, env, account, region):
+        self.env = env
+        self.account = account
+        self.region = region
+
+    def record(self, operation):
+        self.env.stats.call(self.service, operation)
+        if self.env.latency:
+            time.sleep(self.env.latency)
+
+    def throttled(self, operation):
+        return self.env.throttle and self.env.rng.random() < self.env.throttle
+
+
+class FakeSTS(FakeClient):
+    service = 'sts'
+
+    def get_caller_identity(self):
+        self.record('GetCallerIdentity')
+        return {'Account': self.account}
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        self.record('AssumeRole')
+        account = RoleArn.split(':')[4]
+        role_name = RoleArn.split('/')[-1]
+        return {
+            'Credentials': {
+                'AccessKeyId': f'AKIA{account}',
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token',
+                'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+            },
+            'AssumedRoleUser': {
+                'Arn': f'arn:aws:sts::{account}:assumed-role/{role_name}/{RoleSessionName}',
+            },
+        }
+
+
+class FakeEMR(FakeClient):
+    service = 'emr'
+
+    def fleet(self):
+        return self.env.org.clusters.get((self.account, self.region), [])
+
+    def get_paginator(self, operation):
+        if operation == 'list_clusters':
+            return FakePaginator(self.list_cluster_pages)
+        return FakePaginator(self.bootstrap_action_pages)
+
+    def list_cluster_pages(self, CreatedAfter=None, ClusterStates=None):
+        fleet = [c for c in self.fleet() if not ClusterStates or c['Status']['State'] in ClusterStates]
+        if CreatedAfter:
+            fleet = [c for c in fleet if c['Status']['Timeline']['CreationDateTime'] >= CreatedAfter]
+        for i in range(0, max(len(fleet), 1), 50):
+            self.record('ListClusters')
+            yield {'Clusters': [
+                {'Id': c['Id'], 'Name': c['Name'], 'ClusterArn': c['ClusterArn'], 'Status': c['Status']}
+                for c in fleet[i:i + 50]
+            ]}
+
+    def bootstrap_action_pages(self, ClusterId):
+        self.record('ListBootstrapActions')
+        cluster = self.find(ClusterId)
+        yield {'BootstrapActions': [{'Name': path, 'ScriptPath': path} for path in cluster['BootstrapScripts']]}
+
+    def describe_cluster(self, ClusterId):
+        self.record('DescribeCluster')
+        cluster = self.find(ClusterId)
+        return {'Cluster': {'Id': ClusterId, 'ClusterArn': cluster['ClusterArn'], 'Status': cluster['Status'],
+                            'Tags': cluster['Tags']}}
+
+    def find(self, cluster_id):
+        cluster = self.env.org.by_id.get(cluster_id)
+        if cluster and cluster['ClusterArn'].split(':')[4] == self.account:
+            return cluster
+        raise ClientError({'Error': {'Code': 'InvalidRequestException'}}, 'DescribeCluster')
+
+
+class FakeSecurityHub(FakeClient):
+    service = 'securityhub'
+    rate_limit = 10
+    burst_limit = 30
+
+    def __init__(self, env, account, region):
+        super().__init__(env, account, region)
+        key = (account, region)
+        with env.lock:
+            if key not in env.sechub_buckets:
+                env.sechub_buckets[key] = [float(self.burst_limit), time.monotonic()]
+        self.bucket = env.sechub_buckets[key]
+
+    def batch_import_findings(self, Findings):
+        self.record('BatchImportFindings')
+        with self.env.lock:
+            # The real service limits calls per account and region
+            now = time.monotonic()
+            self.bucket[0] = min(self.burst_limit, self.bucket[0] + (now - self.bucket[1]) * self.rate_limit)
+            self.bucket[1] = now
+            if self.bucket[0] < 1:
+                self.env.stats.throttle(self.service, 'BatchImportFindings')
+                raise ClientError({'Error': {'Code': 'TooManyRequestsException'}}, 'BatchImportFindings')
+            self.bucket[0] -= 1
+        failed = []
+        for finding in Findings:
+            if self.throttled('BatchImportFindings'):
+                failed.append({'Id': finding['Id'], 'ErrorCode': 'InternalException', 'ErrorMessage': 'simulated'})
+        if failed:
+            self.env.stats.throttle(self.service, 'FailedFindings', len(failed))
+        with self.env.lock:
+            self.env.findings_imported += len(Findings) - len(failed)
+        return {'FailedCount': len(failed), 'SuccessCount': len(Findings) - len(failed), 'FailedFindings': failed}
+
+
+class FakeS3(FakeClient):
+    service = 's3'
+
+    def get_object(self, Bucket, Key):
+        self.record('GetObject')
+        return {'Body': FakeBody(f'#!/bin/bash\n# {Bucket}/{Key}\n'.encode('utf-8'))}
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self, chunk_size=1024):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+
+
+class FakeLambda(FakeClient):
+    service = 'lambda'
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.record('Invoke')
+        with self.env.lock:
+            self.env.invocations.append(json.loads(Payload))
+        return {'StatusCode': 202}
+
+
+class FakeDynamoDB(FakeClient):
+    service = 'dynamodb'
+
+    def get_paginator(self, operation):
+        return FakePaginator(self.account_pages if operation in ('scan', 'query') else None)
+
+    def account_pages(self, **kwargs):
+        self.record('Scan' if 'FilterExpression' in kwargs else 'Query')
+        yield {'Items': [{'ID': {'S': account}, 'Name': {'S': f'org-{account}'}} for account in self.env.org.accounts]}
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None):
+        self.record('BatchWriteItem')
+        unprocessed = {}
+        units = 0
+        for table_name, requests in RequestItems.items():
+            rows = self.env.tables.setdefault(table_name, {})
+            for request in requests:
+                if self.throttled('BatchWriteItem'):
+                    unprocessed.setdefault(table_name, []).append(request)
+                    continue
+                units += 1
+                with self.env.lock:
+                    if 'PutRequest' in request:
+                        item = {k: next(iter(v.values())) for k, v in request['PutRequest']['Item'].items()}
+                        rows[item[self.env.db_key]] = item
+                    else:
+                        key = next(iter(request['DeleteRequest']['Key'].values()))
+                        rows.pop(next(iter(key.values())), None)
+        if unprocessed:
+            self.env.stats.throttle(self.service, 'UnprocessedItems', sum(len(v) for v in unprocessed.values()))
+        return {
+            'UnprocessedItems': unprocessed,
+            'ConsumedCapacity': [{'TableName': t, 'CapacityUnits': units} for t in RequestItems],
+            'ResponseMetadata': {'RetryAttempts': 0, 'HTTPStatusCode': 200},
+        }
+
+
+class FakeTable:
+    def __init__(self, env, name):
+        self.env = env
+        self.name = name
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, **kwargs):
+        self.env.stats.call('dynamodb', 'Query')
+        account_id = KeyConditionExpression.get_expression()['values'][1]
+        with self.env.lock:
+            rows = sorted((k, v) for k, v in self.env.tables.get(self.name, {}).items()
+                          if v.get('Account ID') == account_id)
+        start = 0
+        if ExclusiveStartKey:
+            start = [k for k, v in rows].index(ExclusiveStartKey[self.env.db_key]) + 1
+        page = rows[start:start + self.env.page_size]
+        response = {'Items': [dict(v) for k, v in page], 'Count': len(page), 'ScannedCount': len(page)}
+        if start + self.env.page_size < len(rows):
+            response['LastEvaluatedKey'] = {self.env.db_key: page[-1][0]}
+        return response
+
+
+class FakeResource:
+    def __init__(self, env):
+        self.env = env
+
+    def Table(self, name):
+        return FakeTable(self.env, name)
+
+
+class FakeSession:
+    # Stands in for boto3.session.Session, the access key carries the account of an assumed role
+    def __init__(self, env, aws_access_key_id=None, **kwargs):
+        self.env = env
+        self.account = aws_access_key_id[4:] if aws_access_key_id else HUB_ACCOUNT
+
+    def client(self, service_name, region_name=None, **kwargs):
+        return self.env.client(service_name, self.account, region_name or HOME_REGION)
+
+    def resource(self, service_name, **kwargs):
+        return FakeResource(self.env)
+
+
+class FakeEnvironment:
+    services = {
+        'sts': FakeSTS,
+        'emr': FakeEMR,
+        'securityhub': FakeSecurityHub,
+        'dynamodb': FakeDynamoDB,
+        's3': FakeS3,
+        'lambda': FakeLambda,
+    }
+
+    def __init__(self, org, throttle, latency, seed, db_key, page_size=100):
+        self.org = org
+        self.throttle = throttle
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.db_key = db_key
+        self.page_size = page_size
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.sechub_buckets = {}
+        self.findings_imported = 0
+        self.invocations = []  # payloads of the async child invocations, run by main() after the orchestrator
+
+    def client(self, service_name, account=HUB_ACCOUNT, region_name=HOME_REGION, **kwargs):
+        return self.services.get(service_name, FakeClient)(self, account, region_name)
+
+    def install(self):
+        boto3.client = lambda service_name, **kwargs: self.client(service_name, HUB_ACCOUNT, kwargs.get('region_name') or HOME_REGION)
+        boto3.resource = lambda service_name, **kwargs: FakeResource(self)
+        boto3.session.Session = lambda **kwargs: FakeSession(self, **kwargs)
+
+
+class FakeContext:
+    function_name = 'emr-bootstrap-benchmark'
+
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def load_lambda(args):
+    os.environ.update({
+        'DYNAMODB_TABLE': 'emr-bootstrap-findings',
+        'DYNAMODB_INDEX': 'AccountIndex',
+        'DYNAMODB_KEY': 'Cluster ID',
+        'EXCLUDED_ACCOUNTS': '',
+        'X_ACCOUNT_ROLE': 'benchmark-role',
+        'AWS_REGION': HOME_REGION,
+        'AWS_LAMBDA_FUNCTION_NAME': FakeContext.function_name,
+        'SEVERITY': 'MEDIUM',
+        'ORCHESTRATION_MODE': args.mode,
+        'MAX_WORKERS': str(args.workers),
+        'REGIONS': ','.join(args.regions),
+    })
+    spec = importlib.util.spec_from_file_location('emr_approved_bootstrap_script', LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def print_run(run, env, elapsed, peak, children):
+    print(f'\nRun {run}: {elapsed:.2f} seconds, peak traced memory {peak / 1024 / 1024:.1f} MiB, '
+          f'{env.findings_imported} findings imported, {children} child invocations run')
+    active = sum(1 for fleet in env.org.clusters.values() for cluster in fleet if cluster['Status']['State'] != 'TERMINATED')
+    rows = sum(1 for table in env.tables.values() for key in table if not str(key).startswith('CHECKPOINT#'))
+    print(f'  findings table rows {rows} ({active} active clusters in the org)')
+    by_service = collections.Counter()
+    for (service, operation), count in env.stats.calls.items():
+        by_service[service] += count
+    for service, count in sorted(by_service.items()):
+        print(f'  {service:<12} {count:>9} calls')
+        for (s, operation), op_count in sorted(env.stats.calls.items()):
+            if s == service:
+                print(f'    {operation:<28} {op_count:>9}')
+    for (service, operation), count in sorted(env.stats.throttles.items()):
+        print(f'  throttled {service}.{operation}: {count}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the EMR bootstrap compliance Lambda against a synthetic org')
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--clusters', type=int, default=50, help='clusters per account and region')
+    parser.add_argument('--regions', nargs='+', default=[HOME_REGION])
+    parser.add_argument('--compliant-ratio', type=float, default=0.8)
+    parser.add_argument('--runs', type=int, default=2, help='later runs show steady state behaviour')
+    parser.add_argument('--mode', default='inline', choices=['inline', 'invoke'])
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='probability that a DynamoDB write or Security Hub finding is rejected')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated latency added to every call')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    org = SyntheticOrg(args.accounts, args.clusters, args.regions, args.compliant_ratio, args.seed)
+    env = FakeEnvironment(org, args.throttle, args.latency_ms / 1000.0, args.seed, 'Cluster ID')
+    env.install()
+    module = load_lambda(args)
+    print(f'Synthetic org: {args.accounts} accounts x {len(args.regions)} regions x {args.clusters} clusters')
+
+    for run in range(1, args.runs + 1):
+        env.stats.reset()
+        env.findings_imported = 0
+        tracemalloc.start()
+        start = time.perf_counter()
+        # The Lambda prints a line per cluster, keep the report readable
+        children = 0
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            module.lambda_handler({'source': 'aws.events'}, FakeContext(timeout=900))
+            while env.invocations:
+                children += 1
+                module.lambda_handler(env.invocations.pop(0), FakeContext(timeout=900))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print_run(run, env, elapsed, peak, children)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,6 +3,7 @@
 # find a way to indent the policy rendering, i know this is a hack, please don't judge me... 🖖
 #
 import boto3
+import hashlib
 import json
 import os
 import yaml
@@ -33,6 +34,26 @@ def make_json(csvFilePath, jsonFilePath):
     with open(jsonFilePath, 'w', encoding='utf-8') as jsonf:
         jsonf.write(json.dumps(data, indent=4))
 
+# Stores an inline policy once per distinct document, named after the sha256 of its canonical JSON
+# (sorted keys, no whitespace). Permission sets with the same policy point at the same file and a file
+# that already exists is not written again, so unchanged policies are left alone between runs.
+stored_policies = {}
+def store_policy(policy_document, directory):
+  if policy_document in stored_policies:
+    return stored_policies[policy_document]
+
+  policy = json.loads(policy_document)
+  canonical = json.dumps(policy, sort_keys=True, separators=(',', ':'))
+  policy_hash = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+  file_path = f"{directory}/{policy_hash}.json"
+  if not os.path.exists(file_path):
+    with open(file_path + '.tmp', 'w') as w:
+      w.write(json.dumps(policy, indent=4))
+    os.replace(file_path + '.tmp', file_path)
+
+  stored_policies[policy_document] = (policy_hash, file_path)
+  return stored_policies[policy_document]
+
 sso = boto3.client('sso-admin')
 
 instances = sso.list_instances() # using [0] is daft, but not sure it is possible to have two instances in a region?
@@ -120,10 +141,9 @@ with open(jsonFilePath) as f:
           os.makedirs(policy_directory)
       try: 
         if response['InlinePolicy']:
-          file_path = f"{policy_directory}/{detail['PermissionSet']['Name']}.json"
+          policy_hash, file_path = store_policy(response['InlinePolicy'], policy_directory)
           ps_object["inline_policy_document_file"]=file_path
-          with open(file_path, 'w') as w:
-              w.write(json.dumps(json.loads(response['InlinePolicy']), indent=4))
+          ps_object["inline_policy_hash"]=policy_hash
       except Exception as e:
         print(e)
         
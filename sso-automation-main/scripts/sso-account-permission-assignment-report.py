@@ -1,11 +1,55 @@
+import argparse
 import boto3
 import csv
+import gzip
 import json
+import os
+import sqlite3
 import string
+import threading
 import time
 import unicodedata
-
-from datetime import datetime
+import zlib
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+# Number of (account, permission set) pairs processed concurrently
+max_workers = 16
+# Seconds between progress lines
+progress_interval = 10
+# Only query the accounts each permission set is provisioned to (see list_provisioned_accounts)
+use_provisioned_accounts = True
+# User and group lookups are kept on disk between runs for identity_cache_ttl seconds (None disables the file),
+# group memberships are always read from the identity store once per run
+identity_cache_file = './identity-cache.json'
+identity_cache_ttl = 3 * 24 * 3600
+# Permission set names by arn are kept on disk between runs (None disables the file)
+permission_set_cache_file = './permission-set-cache.json'
+# Seconds between fsync checkpoints of the report file while it is being written
+checkpoint_interval = 30
+# Assignments, group memberships and permission sets of the last run, used to only query what changed since (None disables it)
+snapshot_file = './assignment-snapshot.db'
+# CloudTrail delivers events up to about 15 minutes late, the change lookup starts this many seconds before the last run
+cloudtrail_delay = 3600
+report_fieldnames = ['AccountID', 'AccountName', 'ObjectType', 'ObjectName', 'PermissionSet', 'GroupMapping', 'GroupId', 'GroupName'] # The header/column names
+delta_fieldnames = ['Change'] + report_fieldnames
+
+# 'adaptive' retry mode adds client side rate limiting that backs off when SSO Admin or Identity Store
+# return throttling errors and speeds back up as calls succeed. The clients are shared by all the
+# worker threads so they share one rate limiter (boto3 clients are thread safe, creating them is not).
+config = Config(
+    retries={
+        'max_attempts': 20,
+        'mode': 'adaptive'
+    },
+    max_pool_connections=max_workers
+)
+sso_admin_client = boto3.client('sso-admin', config=config)
+identity_store_client = boto3.client('identitystore', config=config)
 
 """
 list_accounts
@@ -42,7 +86,7 @@ Returns:
 -- List[Dictionary]: sso_instance_list (a list of sso instances each described by a dictionary with keys 'instanceArn' and 'identityStore')
 """
 def list_existing_sso_instances():
-    client = boto3.client('sso-admin')
+    client = sso_admin_client
 
     sso_instance_list = []
     response = client.list_instances()
@@ -63,7 +107,7 @@ Returns:
 -- Dictionary: perm_set_dict (a dictionary with permission sets with key permission set name and value permission set arn)
 """
 def list_permission_sets(ssoInstanceArn):
-    client = boto3.client('sso-admin')
+    client = sso_admin_client
 
     perm_set_dict = {}
 
@@ -74,15 +118,82 @@ def list_permission_sets(ssoInstanceArn):
         response = client.list_permission_sets(InstanceArn=ssoInstanceArn, NextToken=response["NextToken"])
         results.extend(response["PermissionSets"])
 
+    # get the names of the permission sets from the arns
+    names = describe_permission_set_names(ssoInstanceArn, results)
     for permission_set in results:
-        # get the name of the permission set from the arn
-        perm_description = client.describe_permission_set(InstanceArn=ssoInstanceArn,PermissionSetArn=permission_set)
         # key: permission set name, value: permission set arn
-        perm_set_dict[perm_description["PermissionSet"]["Name"]] = permission_set
+        perm_set_dict[names[permission_set]] = permission_set
 
 
     return perm_set_dict
 
+"""
+describe_permission_set_names
+
+Looks up the names of permission sets. Names are read from permission_set_cache_file and the permission sets that are
+not in it are described concurrently. A permission set cannot be renamed (a new name replaces it with a new arn), so
+cached names do not go stale and only the current arns are written back to the file.
+
+Parameters:
+-- String: ssoInstanceArn
+-- List[String]: permission_set_arns
+Returns:
+-- Dictionary: names (a dictionary with key permission set arn and value permission set name)
+"""
+def describe_permission_set_names(ssoInstanceArn, permission_set_arns):
+    cached_names = {}
+    if permission_set_cache_file and os.path.exists(permission_set_cache_file):
+        try:
+            with open(permission_set_cache_file) as f:
+                cached_names = json.load(f)
+        except ValueError:
+            print("[WARN] Ignoring unreadable permission set cache file " + permission_set_cache_file)
+
+    missing = [arn for arn in permission_set_arns if arn not in cached_names]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        described = executor.map(
+            lambda arn: sso_admin_client.describe_permission_set(InstanceArn=ssoInstanceArn, PermissionSetArn=arn)["PermissionSet"]["Name"],
+            missing
+        )
+        cached_names.update(zip(missing, described))
+    print("Described " + str(len(missing)) + " of " + str(len(permission_set_arns)) + " permission sets, the others were cached")
+
+    names = {arn: cached_names[arn] for arn in permission_set_arns}
+    if permission_set_cache_file:
+        with open(permission_set_cache_file + '.tmp', 'w') as f:
+            json.dump(names, f, indent=2)
+        os.replace(permission_set_cache_file + '.tmp', permission_set_cache_file)
+    return names
+
+
+"""
+list_provisioned_accounts
+
+Lists the AWS accounts that a permission set is provisioned to. A permission set can only have assignments
+in accounts it is provisioned to, so these are the only accounts worth asking about it.
+
+Parameters:
+-- String: ssoInstanceArn
+-- String: permissionSetArn
+Returns:
+-- Set[String]: account_ids (the ids of the accounts the permission set is provisioned to)
+"""
+def list_provisioned_accounts(ssoInstanceArn, permissionSetArn):
+    client = sso_admin_client
+
+    paginator = client.get_paginator("list_accounts_for_provisioned_permission_set")
+
+    response_iterator = paginator.paginate(
+        InstanceArn=ssoInstanceArn,
+        PermissionSetArn=permissionSetArn
+    )
+
+    account_ids = set()
+    for response in response_iterator:
+        account_ids.update(response['AccountIds'])
+
+    return account_ids
+
 
 """
 list_account_assignments
@@ -97,7 +208,7 @@ Returns:
 -- List[Dictionary]: account_assignments (a list of account assignments represented by dictionaries with the keys 'PrincipalType' and 'PrincipalId')
 """
 def list_account_assignments(ssoInstanceArn, accountId, permissionSetArn):
-    client = boto3.client('sso-admin')
+    client = sso_admin_client
 
     paginator = client.get_paginator("list_account_assignments")
 
@@ -116,24 +227,21 @@ def list_account_assignments(ssoInstanceArn, accountId, permissionSetArn):
     return account_assignments
 
 
-def is_group_assignmented_to_account(ssoInstanceArn, accountId, permissionSetArn, group):
-    client = boto3.client('sso-admin')
+"""
+is_group_assignmented_to_account
 
-    paginator = client.get_paginator("list_account_assignments")
-
-    response_iterator = paginator.paginate(
-        InstanceArn=ssoInstanceArn,
-        AccountId=accountId,
-        PermissionSetArn=permissionSetArn
-    )
-    group_found = False
-    for response in response_iterator:
-        for id in response['AccountAssignments']:
-            if id['PrincipalId'] == group.get('GroupId',""):
-              group_found = True
-              # print(response)
-              # print(f"Validated Group {group['DisplayName']} is assigned to Account {accountId}")
+Checks whether a group is one of the principals assigned to the account and permission set, using the assignments
+already returned by list_account_assignments.
 
+Parameters:
+-- List[Dictionary]: account_assignments (the result of list_account_assignments for the account and permission set)
+-- Dictionary: group (the identity store group)
+Returns:
+-- Boolean: group_found
+"""
+def is_group_assignmented_to_account(account_assignments, group):
+    group_id = group.get('GroupId',"")
+    group_found = any(assignment['PrincipalId'] == group_id for assignment in account_assignments)
     return group_found
 
 """
@@ -148,117 +256,238 @@ Returns:
 -- Dictionary: username and userid
 """
 def describe_user(userId, identityStoreId):
-    client = boto3.client('identitystore')
-
-    response = client.describe_user(
-        IdentityStoreId=identityStoreId,
-        UserId=userId
-    )
-    userName = response['UserName']
-    userId = response['UserId']
+    user = get_identity_resolver(identityStoreId).describe_user(userId)
 
     userInfo = {
-      "userName": userName,
-      "userId": userId
+      "userName": user['UserName'],
+      "userId": user['UserId']
     }
     
     return userInfo
 
+"""
+get_group_members
+
+Retrieves the members of a group in an identity store.
+
+Parameters:
+-- String: identityStoreId
+-- String: group_id
+Returns:
+-- List[Dictionary]: member_list (the describe_user response of each member)
+"""
 def get_group_members(identityStoreId, group_id):
-    client = boto3.client('identitystore')
-    member_list = []
-    list_group_memberships_response = client.list_group_memberships(
-        IdentityStoreId=identityStoreId,
-        GroupId=group_id,
-        MaxResults=100,
-    )
-    group_membership_response = list_group_memberships_response["GroupMemberships"]
-    for group_membership in group_membership_response:
-        member_id = format(group_membership["MemberId"]["UserId"])
-        describe_user_response = client.describe_user(
-            IdentityStoreId=identityStoreId,
-            UserId=member_id
-        )
-        member_list.append(describe_user_response)
-    return member_list
+    return get_identity_resolver(identityStoreId).get_group_members(group_id)
 
 """
 is_member_in_group
 
-Retrieves the group metadata and attributes from group id in an identity store to return a human friendly group name.
+Checks whether a user is a member of a group in an identity store. The group's members are fetched once and
+every later check is a set lookup.
 
 Parameters:
+-- String: memberID
 -- String: groupId
 -- String: identityStoreId
 Returns:
--- String: groupname (a human friendly groupname for the group id)
+-- Dictionary: result (the is_member_in_groups result with keys 'GroupId', 'MemberId' and 'MembershipExists')
 """
 def is_member_in_groups(memberID, groupId, identityStoreId):
-    client = boto3.client('identitystore')
     try:
-      response = client.is_member_in_groups(
-          IdentityStoreId=identityStoreId,
-          MemberId={
-              'UserId': memberID
-          },
-          GroupIds=[
-              groupId,
-          ]
-      )
-      results = response['Results']
-      return results[0]
+      return get_identity_resolver(identityStoreId).is_member_in_group(memberID, groupId)
     except Exception as e:
         print(e)
 
 
+"""
+IdentityResolver
+
+Resolves users, groups, group members and group memberships in an identity store. Every lookup is cached for
+the run. Users and groups are also kept in identity_cache_file for identity_cache_ttl seconds so later runs skip
+principals that were already resolved; group members are not, since the report is about who has access now.
+Hits and misses are counted per kind of lookup.
+"""
+class IdentityResolver:
+    kinds = ['users', 'groups', 'group_member_ids']
+    persisted_kinds = ['users', 'groups']
+
+    def __init__(self, identityStoreId, cache_file=None, ttl=identity_cache_ttl):
+        self.client = identity_store_client
+        self.identityStoreId = identityStoreId
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.caches = {kind: {} for kind in self.kinds}
+        self.member_sets = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.load()
+
+    def cached(self, kind, key, fetch):
+        with self.lock:
+            entry = self.caches[kind].get(key)
+            if entry is not None:
+                self.hits[kind] += 1
+                return entry[1]
+            self.misses[kind] += 1
+        # failed lookups raise and are not cached
+        value = fetch()
+        with self.lock:
+            self.caches[kind][key] = [time.time(), value]
+        return value
+
+    def describe_user(self, userId):
+        def fetch():
+            response = self.client.describe_user(IdentityStoreId=self.identityStoreId, UserId=userId)
+            response.pop('ResponseMetadata', None)
+            return response
+        return self.cached('users', userId, fetch)
+
+    def describe_group(self, groupId):
+        def fetch():
+            response = self.client.describe_group(IdentityStoreId=self.identityStoreId, GroupId=groupId)
+            return response['DisplayName']
+        return self.cached('groups', groupId, fetch)
+
+    def fetch_group_member_ids(self, groupId):
+        # all pages of the group's memberships, not just the first 100
+        paginator = self.client.get_paginator('list_group_memberships')
+        member_ids = []
+        for page in paginator.paginate(IdentityStoreId=self.identityStoreId, GroupId=groupId):
+            for member in page["GroupMemberships"]:
+                member_ids.append(member["MemberId"]["UserId"])
+        return member_ids
+
+    def get_group_member_ids(self, groupId):
+        return self.cached('group_member_ids', groupId, lambda: self.fetch_group_member_ids(groupId))
+
+    def get_group_member_set(self, groupId):
+        with self.lock:
+            member_set = self.member_sets.get(groupId)
+        if member_set is None:
+            member_set = frozenset(self.get_group_member_ids(groupId))
+            with self.lock:
+                self.member_sets[groupId] = member_set
+        return member_set
+
+    def get_group_members(self, groupId):
+        return [self.describe_user(member_id) for member_id in self.get_group_member_ids(groupId)]
+
+    def is_member_in_group(self, memberID, groupId):
+        return {
+            'GroupId': groupId,
+            'MemberId': {'UserId': memberID},
+            'MembershipExists': memberID in self.get_group_member_set(groupId)
+        }
+
+    def load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as f:
+                data = json.load(f).get(self.identityStoreId, {})
+        except ValueError:
+            print("[WARN] Ignoring unreadable identity cache file " + self.cache_file)
+            return
+        oldest = time.time() - self.ttl
+        for kind in self.persisted_kinds:
+            for key, entry in data.get(kind, {}).items():
+                if entry[0] >= oldest:
+                    self.caches[kind][key] = entry
+
+    def save(self):
+        if not self.cache_file:
+            return
+        data = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file) as f:
+                    data = json.load(f)
+            except ValueError:
+                data = {}
+        with self.lock:
+            data[self.identityStoreId] = {kind: self.caches[kind] for kind in self.persisted_kinds}
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump(data, f, default=str)
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+    def print_stats(self):
+        for kind in self.kinds:
+            print(f"Identity cache {kind}: {self.hits[kind]} hits, {self.misses[kind]} misses")
+
+identity_resolvers = {}
+identity_resolvers_lock = threading.Lock()
+
+def get_identity_resolver(identityStoreId):
+    with identity_resolvers_lock:
+        if identityStoreId not in identity_resolvers:
+            identity_resolvers[identityStoreId] = IdentityResolver(identityStoreId, identity_cache_file)
+        return identity_resolvers[identityStoreId]
+
+
 """
 find_permission_set_group_mapping
 
-Retrieves the group metadata and attributes from group id in an identity store to return a human friendly group name.
+Finds the group mapped to a permission set on an account in the mapping files.
 
 Parameters:
--- String: groupId
+-- String: permission_set
+-- String: accountId
 -- String: identityStoreId
 Returns:
--- String: groupname (a human friendly groupname for the group id)
+-- Dictionary: group (the identity store group, empty if there is no mapping)
 """
 def find_permission_set_group_mapping(permission_set, accountId, identityStoreId):
-  id_client = boto3.client('identitystore')
-  with open('./config/mapping-legacy-groups.json') as f: 
-    data = json.load(f)
-    group = {}
-    for item in data: 
-      #print(f"{item}|{account}|{permission_set}")
-      if accountId == item['AccountNum'] and permission_set == item['PermissionSet'] :
-        group_response = id_client.list_groups(
-        IdentityStoreId=identityStoreId,
-          Filters=[{"AttributePath": "DisplayName", "AttributeValue": f"{item['Group']}"}],
-            )
-        
-        group = group_response['Groups'][0]
-  if len(group) != 1: #if we don't find the mapping in the legacy config, we check in the workload config
-    with open('./config/mapping-workload-groups.json') as f: 
-      data = json.load(f)
-      for item in data: 
-        #print(f"{item}|{account}|{permission_set}")
-        if accountId == item['AccountNum'] and permission_set == item['PermissionSet']:
-          group_response = id_client.list_groups(
-          IdentityStoreId=identityStoreId,
-            Filters=[{"AttributePath": "DisplayName", "AttributeValue": f"{item['Group']}"}],
-              )
-          group = group_response['Groups'][0]
-  if len(group) != 1: #if we don't find the mapping in the legacy config, we check in the workload config
-    with open('./config/mapping-management-groups.json') as f: 
-      data = json.load(f)
-      for item in data: 
-        #print(f"{item}|{account}|{permission_set}")
-        if accountId in item['account_assignments'] and permission_set == item['PermissionSet']:
-          group_response = id_client.list_groups(
-          IdentityStoreId=identityStoreId,
-            Filters=[{"AttributePath": "DisplayName", "AttributeValue": f"{item['Group']}"}],
-              )
-          group = group_response['Groups'][0]
-  return group
+  return get_group_mapping_index(identityStoreId).get((accountId, permission_set), {})
+
+"""
+load_group_mapping_index
+
+Loads the legacy, workload and management mapping files into one dictionary keyed by (AccountNum, PermissionSet),
+with the management account_assignments lists expanded. When a pair is mapped more than once the later file and
+the later entry win, which matches the order the files were previously searched in. Group display names are
+resolved to groups with one pass over list_groups.
+
+Parameters:
+-- String: identityStoreId
+Returns:
+-- Dictionary: index (key (account id, permission set name), value identity store group)
+"""
+def load_group_mapping_index(identityStoreId):
+  group_names = {}
+  with open('./config/mapping-legacy-groups.json') as f:
+    for item in json.load(f):
+      group_names[(item['AccountNum'], item['PermissionSet'])] = item['Group']
+  with open('./config/mapping-workload-groups.json') as f:
+    for item in json.load(f):
+      group_names[(item['AccountNum'], item['PermissionSet'])] = item['Group']
+  with open('./config/mapping-management-groups.json') as f:
+    for item in json.load(f):
+      for accountId in item['account_assignments']:
+        group_names[(accountId, item['PermissionSet'])] = item['Group']
+
+  groups = {}
+  paginator = identity_store_client.get_paginator('list_groups')
+  for page in paginator.paginate(IdentityStoreId=identityStoreId):
+    for group in page['Groups']:
+      groups[group['DisplayName']] = group
+
+  index = {}
+  for key, group_name in group_names.items():
+    if group_name in groups:
+      index[key] = groups[group_name]
+    else:
+      print(f"[WARN] Mapped group {group_name} was not found in the identity store")
+  return index
+
+group_mapping_indexes = {}
+group_mapping_lock = threading.Lock()
+
+def get_group_mapping_index(identityStoreId):
+  with group_mapping_lock:
+    if identityStoreId not in group_mapping_indexes:
+      group_mapping_indexes[identityStoreId] = load_group_mapping_index(identityStoreId)
+    return group_mapping_indexes[identityStoreId]
 
 """
 describe_group
@@ -272,13 +501,8 @@ Returns:
 -- String: groupname (a human friendly groupname for the group id)
 """
 def describe_group(groupId, identityStoreId):
-    client = boto3.client('identitystore')
     try:
-        response = client.describe_group(
-            IdentityStoreId=identityStoreId,
-            GroupId=groupId
-        )
-        groupname = response['DisplayName']
+        groupname = get_identity_resolver(identityStoreId).describe_group(groupId)
         return groupname
     except Exception as e:
         print("[WARN] Group was deleted while the report was running: " + str(groupId))
@@ -290,123 +514,523 @@ def describe_group(groupId, identityStoreId):
 create_report
 
 Creates a report of the assigned permissions on users for all accounts in an organization.
+The (account, permission set) pairs are processed concurrently on max_workers threads and their rows are
+handed to the report writer in the same order as a serial run. Pairs already completed by a resumed run are
+skipped, and with a snapshot the pairs that did not change since the last run are copied from it.
 
 Parameters:
 -- List[Dictionary]: account_list (a list of accounts each described by a dictionary with keys 'name' and 'id')
--- List[Dictionary]: sso_instance (a list of sso instances each described by a dictionary with keys 'instanceArn' and 'identityStore')
+-- Dictionary: sso_instance (an sso instance described by a dictionary with keys 'instanceArn' and 'identityStore')
 -- Dictionary: permission_sets_list (a dictionary with permission sets with key permission set name and value permission set arn)
+-- ReportWriter: report_writer (receives the rows of each pair as it is completed)
+-- SnapshotStore: snapshot (the previous run's snapshot, None to query every pair without recording a snapshot)
+-- Boolean: full (query every pair even when the snapshot shows it unchanged)
+-- Integer: break_after (only report on the first break_after accounts, for testing)
+-- Boolean: dry_run
 Returns:
--- List[Dictionary]: result (a list of dictionaries with keys 'AccountID', 'AccountName', 'PermissionSet', 'ObjectName', 'ObjectType')
-"""
-def create_report(account_list, sso_instance, permission_sets_list, break_after=None, dry_run=True):
-    result = []
-
-    # variables for displaying the progress of processed accounts
-    length = str(len(account_list))
-    i = 1
-
-    for account in account_list:
-        print(f"Identifying permissions for {account['name']}")
-        for permission_set in permission_sets_list.keys():
-            print(f"Identifying permissions for {account['name']} and {permission_set}")
-            # get all the users assigned to a permission set on the current account
-            account_assignments = list_account_assignments(sso_instance['instanceArn'], account['id'], permission_sets_list[permission_set])
-
-            # add the users and additional information to the sso report result
-            for account_assignment in account_assignments:
-
-                account_assignments_dic = {}
-
-                # add information for all the headers
-                account_assignments_dic['AccountID'] = account['id']
-                account_assignments_dic['AccountName'] = account['name']
-                account_assignments_dic['PermissionSet'] = permission_set
-                account_assignments_dic['ObjectType'] = account_assignment['PrincipalType']
-                sso_instance_arn = sso_instance['instanceArn']
-                pset_arn = permission_sets_list[permission_set]
-                print(f"Identifying permissions for {account['name']} and {permission_set} and {pset_arn}")
-                # find human friendly name for user id if principal type is "USER"
-                if account_assignments_dic['ObjectType'] == "USER":
-                    userinfo = describe_user(account_assignment['PrincipalId'], sso_instance['identityStore'])
-                    userName = userinfo['userName']
-                    userId = userinfo ['userId']
-                    account_assignments_dic['ObjectName'] = userName
-                    group = find_permission_set_group_mapping(permission_set=permission_set, accountId=account['id'],identityStoreId=sso_instance['identityStore'])
-                    is_assigned = is_group_assignmented_to_account(ssoInstanceArn=sso_instance_arn, permissionSetArn=pset_arn, accountId=account['id'], group=group)
-                    
-                    if len(group) > 0: #if we have a mapped group for their combination
-                      results = is_member_in_groups(memberID=userId, groupId=group['GroupId'], identityStoreId=sso_instance['identityStore']) 
-                      if results['MembershipExists'] == True and is_assigned:  #and they are in the group
-                        
-                        account_assignments_dic['GroupMapping'] = "FoundInGroup"
-                        account_assignments_dic['GroupId'] = results['GroupId']
-                        account_assignments_dic['GroupName'] = group['DisplayName']
-                        print(f"Group Identified: Remove {userName} | {userId} | {account['id']} | | {permission_set} | {pset_arn}  | {group['DisplayName']}")
-                        #remove_user_assignment(principalId=userId, instance_arn=sso_instance_arn, account=account['id'], permission_set_arn=pset_arn,  dry_run=dry_run)
-                      else:
-                        account_assignments_dic['GroupMapping'] = "NotInGroup"
-                        account_assignments_dic['GroupId'] = results['GroupId']
-                        account_assignments_dic['GroupName'] = group['DisplayName']
-
-                    else:
-                      print(f"No Group Mapping Found: {userId} | {account['id']} | {userName} | {permission_set}")
-                      account_assignments_dic['GroupMapping'] = "NotInMapping"
-                      account_assignments_dic['GroupId'] = "NotInMapping"
-                      account_assignments_dic['GroupName'] = "NotInMapping"
-
-                # find human friendly name for group id if principal type is "GROUP"
-                    
-                elif account_assignments_dic['ObjectType'] == "GROUP":
-                    group = find_permission_set_group_mapping(permission_set=permission_set, accountId=account['id'],identityStoreId=sso_instance['identityStore'])
-                    is_assigned = is_group_assignmented_to_account(ssoInstanceArn=sso_instance_arn, permissionSetArn=pset_arn, accountId=account['id'], group=group)
-                    group_id = group.get('GroupId',False)
-                    if group_id:
-                      group_members = get_group_members(sso_instance['identityStore'],group['GroupId'])
-                      if group_members is not None:
-                        for member in group_members:
-                          group_assignments_dic = {}
-                          group_assignments_dic['ObjectName'] = member['UserName']
-                          group_assignments_dic['GroupName'] = group['DisplayName']
-                          group_assignments_dic['GroupMapping'] = is_assigned
-                          group_assignments_dic['GroupId'] = group_id
-                          group_assignments_dic['AccountID'] = account['id']
-                          group_assignments_dic['AccountName'] = account['name']
-                          group_assignments_dic['PermissionSet'] = permission_set
-                          group_assignments_dic['ObjectType'] = account_assignment['PrincipalType']
-                          result.append(group_assignments_dic)
-                result.append(account_assignments_dic)
-        # display the progress of processed accounts
-        print(str(i) + "/" + length + " accounts done")
-        i = i+1
-
-        # debug code used for stopping after a certain amound of accounts for faster testing
-        if break_after != None and i > break_after:
-            break
-
-    return result
-
-"""
-write_result_to_file
-
-Writes a list of dictionaries to a csv file.
+-- None
+Output:
+-- CSV file: the rows written by report_writer (and its delta file when there is a snapshot)
+"""
+def create_report(account_list, sso_instance, permission_sets_list, report_writer, snapshot=None, full=False, break_after=None, dry_run=True):
+    # debug code used for stopping after a certain amount of accounts for faster testing
+    if break_after != None:
+        account_list = account_list[:break_after]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if use_provisioned_accounts:
+            # skip the (account, permission set) pairs where the permission set is not provisioned
+            provisioned = dict(zip(permission_sets_list.keys(), executor.map(
+                lambda permission_set: list_provisioned_accounts(sso_instance['instanceArn'], permission_sets_list[permission_set]),
+                permission_sets_list.keys()
+            )))
+            units = [(account, permission_set) for account in account_list for permission_set in permission_sets_list.keys()
+                     if account['id'] in provisioned[permission_set]]
+            print(str(len(units)) + " of " + str(len(account_list) * len(permission_sets_list)) + " account/permission set pairs are provisioned")
+        else:
+            units = [(account, permission_set) for account in account_list for permission_set in permission_sets_list.keys()]
+        unit_keys = set((account['id'], permission_set) for account, permission_set in units)
+        if report_writer.completed_units:
+            # pairs finished by the run being resumed are already in the report file
+            units = [(account, permission_set) for account, permission_set in units
+                     if (account['id'], permission_set) not in report_writer.completed_units]
+            print("Resuming with " + str(len(units)) + " account/permission set pairs left")
+        unchanged_units = set()
+        if snapshot is not None and not full:
+            unchanged_units = snapshot.unchanged_units(units, executor)
+        progress = Progress(account_list, units)
+
+        # unchanged pairs are copied from the snapshot when their turn comes, the others are queried
+        futures = {
+            executor.submit(create_report_rows, account, permission_set, sso_instance, permission_sets_list): index
+            for index, (account, permission_set) in enumerate(units) if (account['id'], permission_set) not in unchanged_units
+        }
+        # rows are written in unit order, queried units that finish early wait in pending until the ones before them are done
+        completed = as_completed(futures)
+        pending = {}
+        next_index = 0
+        try:
+            while next_index < len(units):
+                account, permission_set = units[next_index]
+                if (account['id'], permission_set) in unchanged_units:
+                    rows = snapshot.get_rows(account['id'], permission_set)
+                    progress.unit_done(account)
+                elif next_index in pending:
+                    rows = pending.pop(next_index)
+                else:
+                    future = next(completed)
+                    index = futures[future]
+                    pending[index] = future.result()
+                    progress.unit_done(units[index][0])
+                    continue
+                report_writer.write_unit(account, permission_set, rows)
+                next_index += 1
+        except BaseException:
+            # on a failed pair or Ctrl-C drop the queued pairs instead of running them all on the way out of the
+            # with block, the pairs written so far can be resumed with --resume
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    progress.print_progress(force=True)
+
+    # a partial run must not mark the pairs it left out as removed
+    if break_after is None:
+        report_writer.finish(unit_keys)
+
+"""
+create_report_rows
+
+Creates the report rows for one account and permission set.
 
 Parameters:
--- String: result
+-- Dictionary: account (an account described by a dictionary with keys 'name' and 'id')
+-- String: permission_set (the permission set name)
+-- Dictionary: sso_instance (an sso instance described by a dictionary with keys 'instanceArn' and 'identityStore')
+-- Dictionary: permission_sets_list (a dictionary with permission sets with key permission set name and value permission set arn)
 Returns:
--- None
-Output:
--- CSV file: CSV with SSO report.
+-- List[Dictionary]: rows (a list of report rows)
+"""
+def create_report_rows(account, permission_set, sso_instance, permission_sets_list):
+    rows = []
+    # get all the users assigned to a permission set on the current account
+    account_assignments = list_account_assignments(sso_instance['instanceArn'], account['id'], permission_sets_list[permission_set])
+
+    # add the users and additional information to the sso report result
+    for account_assignment in account_assignments:
+
+        account_assignments_dic = {}
+
+        # add information for all the headers
+        account_assignments_dic['AccountID'] = account['id']
+        account_assignments_dic['AccountName'] = account['name']
+        account_assignments_dic['PermissionSet'] = permission_set
+        account_assignments_dic['ObjectType'] = account_assignment['PrincipalType']
+        sso_instance_arn = sso_instance['instanceArn']
+        pset_arn = permission_sets_list[permission_set]
+        # find human friendly name for user id if principal type is "USER"
+        if account_assignments_dic['ObjectType'] == "USER":
+            userinfo = describe_user(account_assignment['PrincipalId'], sso_instance['identityStore'])
+            userName = userinfo['userName']
+            userId = userinfo ['userId']
+            account_assignments_dic['ObjectName'] = userName
+            group = find_permission_set_group_mapping(permission_set=permission_set, accountId=account['id'],identityStoreId=sso_instance['identityStore'])
+            is_assigned = is_group_assignmented_to_account(account_assignments, group)
+
+            if len(group) > 0: #if we have a mapped group for their combination
+              results = is_member_in_groups(memberID=userId, groupId=group['GroupId'], identityStoreId=sso_instance['identityStore'])
+              if results['MembershipExists'] == True and is_assigned:  #and they are in the group
+
+                account_assignments_dic['GroupMapping'] = "FoundInGroup"
+                account_assignments_dic['GroupId'] = results['GroupId']
+                account_assignments_dic['GroupName'] = group['DisplayName']
+                print(f"Group Identified: Remove {userName} | {userId} | {account['id']} | | {permission_set} | {pset_arn}  | {group['DisplayName']}")
+                #remove_user_assignment(principalId=userId, instance_arn=sso_instance_arn, account=account['id'], permission_set_arn=pset_arn,  dry_run=dry_run)
+              else:
+                account_assignments_dic['GroupMapping'] = "NotInGroup"
+                account_assignments_dic['GroupId'] = results['GroupId']
+                account_assignments_dic['GroupName'] = group['DisplayName']
+
+            else:
+              print(f"No Group Mapping Found: {userId} | {account['id']} | {userName} | {permission_set}")
+              account_assignments_dic['GroupMapping'] = "NotInMapping"
+              account_assignments_dic['GroupId'] = "NotInMapping"
+              account_assignments_dic['GroupName'] = "NotInMapping"
+
+        # find human friendly name for group id if principal type is "GROUP"
+
+        elif account_assignments_dic['ObjectType'] == "GROUP":
+            group = find_permission_set_group_mapping(permission_set=permission_set, accountId=account['id'],identityStoreId=sso_instance['identityStore'])
+            is_assigned = is_group_assignmented_to_account(account_assignments, group)
+            group_id = group.get('GroupId',False)
+            if group_id:
+              group_members = get_group_members(sso_instance['identityStore'],group['GroupId'])
+              if group_members is not None:
+                for member in group_members:
+                  group_assignments_dic = {}
+                  group_assignments_dic['ObjectName'] = member['UserName']
+                  group_assignments_dic['GroupName'] = group['DisplayName']
+                  group_assignments_dic['GroupMapping'] = is_assigned
+                  group_assignments_dic['GroupId'] = group_id
+                  group_assignments_dic['AccountID'] = account['id']
+                  group_assignments_dic['AccountName'] = account['name']
+                  group_assignments_dic['PermissionSet'] = permission_set
+                  group_assignments_dic['ObjectType'] = account_assignment['PrincipalType']
+                  rows.append(group_assignments_dic)
+        rows.append(account_assignments_dic)
+    return rows
+
+"""
+Progress
+
+Tracks completed (account, permission set) pairs and prints a progress line at most every progress_interval seconds.
 """
-def write_result_to_file(result):
-    filename = 'sso_report_Account_Assignments_' + datetime.now().strftime("%Y-%m-%d_%H.%M.%S") + '.csv'
-    filename = clean_filename(filename)
-    with open(filename, 'w', newline='') as csv_file:
-        fieldnames = ['AccountID', 'AccountName', 'ObjectType', 'ObjectName', 'PermissionSet', 'GroupMapping', 'GroupId', 'GroupName'] # The header/column names
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+class Progress:
+    def __init__(self, account_list, units):
+        self.start = time.time()
+        self.last_print = 0
+        self.total_units = len(units)
+        self.total_accounts = len(account_list)
+        self.units_done = 0
+        self.remaining = {account['id']: 0 for account in account_list}
+        for account, permission_set in units:
+            self.remaining[account['id']] += 1
+        # accounts without any provisioned permission sets have nothing left to do
+        self.accounts_done = sum(1 for count in self.remaining.values() if count == 0)
+
+    def unit_done(self, account):
+        self.units_done += 1
+        self.remaining[account['id']] -= 1
+        if self.remaining[account['id']] == 0:
+            self.accounts_done += 1
+        self.print_progress()
+
+    def print_progress(self, force=False):
+        now = time.time()
+        if not force and now - self.last_print < progress_interval:
+            return
+        self.last_print = now
+        elapsed = now - self.start
+        eta = ""
+        if 0 < self.units_done < self.total_units:
+            eta = " - about " + str(int(elapsed / self.units_done * (self.total_units - self.units_done) / 60)) + " minutes left"
+        print(str(self.accounts_done) + "/" + str(self.total_accounts) + " accounts and " + str(self.units_done) + "/" + str(self.total_units) + " account/permission set pairs done" + eta)
 
-        writer.writeheader()
-        for row in result:
-            writer.writerow(row)
+"""
+ReportWriter
+
+Streams report rows to a csv file (gzip compressed when the filename ends with .gz) as each account and permission set
+pair finishes. Completed pairs are recorded in a <report file>.done file next to the report, both files are fsynced at
+most every checkpoint_interval seconds and when the report is closed. Opening an existing report with resume=True keeps
+the rows of the completed pairs, drops any partial rows written after the last checkpoint and appends to the file.
+With a snapshot every pair is also recorded in the snapshot store and the added and removed rows are written to a
+<report>_delta.csv file.
+
+Parameters:
+-- String: filename
+-- Boolean: resume
+-- SnapshotStore: snapshot
+"""
+class ReportWriter:
+    def __init__(self, filename, resume=False, snapshot=None):
+        self.filename = filename
+        self.done_filename = filename + '.done'
+        self.snapshot = snapshot
+        self.completed_units = set()
+        self.rows_written = 0
+        self.delta_rows_written = 0
+        self.last_checkpoint = time.time()
+        if resume:
+            self.completed_units = self.read_completed_units()
+            self.rows_written = self.rewrite_completed_rows(self.filename, report_fieldnames)
+            accounts = set(account_id for account_id, permission_set in self.completed_units)
+            print("Resuming " + self.filename + ": " + str(self.rows_written) + " rows for " + str(len(self.completed_units)) + " completed account/permission set pairs in " + str(len(accounts)) + " accounts")
+        self.file = self.open(self.filename, 'a' if resume else 'w')
+        self.writer = csv.DictWriter(self.file, fieldnames=report_fieldnames)
+        if not resume:
+            self.writer.writeheader()
+        self.done_file = open(self.done_filename, 'a' if resume else 'w', newline='')
+        self.done_writer = csv.writer(self.done_file)
+        self.delta_file = None
+        if snapshot is not None:
+            self.delta_filename = filename.replace('.csv', '_delta.csv', 1)
+            if resume and os.path.exists(self.delta_filename):
+                self.delta_rows_written = self.rewrite_completed_rows(self.delta_filename, delta_fieldnames)
+                self.delta_file = self.open(self.delta_filename, 'a')
+                self.delta_writer = csv.DictWriter(self.delta_file, fieldnames=delta_fieldnames)
+            else:
+                self.delta_file = self.open(self.delta_filename, 'w')
+                self.delta_writer = csv.DictWriter(self.delta_file, fieldnames=delta_fieldnames)
+                self.delta_writer.writeheader()
+
+    def open(self, filename, mode):
+        # the compression follows the report filename, also for its .tmp file
+        if self.filename.endswith('.gz'):
+            return gzip.open(filename, mode + 't', newline='')
+        return open(filename, mode, newline='')
+
+    def read_completed_units(self):
+        if not os.path.exists(self.done_filename):
+            raise FileNotFoundError("Cannot resume " + self.filename + ", " + self.done_filename + " does not exist")
+        with open(self.done_filename, newline='') as done_file:
+            # a pair is only complete when its line was written in full
+            return set((row[0], row[1]) for row in csv.reader(done_file) if len(row) == 2)
+
+    def rewrite_completed_rows(self, filename, fieldnames):
+        # keep only the rows of completed pairs, rows written after the last checkpoint are queried again
+        tmp_filename = filename + '.tmp'
+        kept = 0
+        with self.open(tmp_filename, 'w') as tmp_file:
+            writer = csv.DictWriter(tmp_file, fieldnames=fieldnames)
+            writer.writeheader()
+            try:
+                with self.open(filename, 'r') as report_file:
+                    for row in csv.DictReader(report_file):
+                        if (row['AccountID'], row['PermissionSet']) in self.completed_units and None not in row.values():
+                            writer.writerow(row)
+                            kept += 1
+            except EOFError:
+                # a gzip file cut off by the interrupted run
+                pass
+        os.replace(tmp_filename, filename)
+        return kept
+
+    def write_unit(self, account, permission_set, rows):
+        self.writer.writerows(rows)
+        self.rows_written += len(rows)
+        self.file.flush()
+        if self.snapshot is not None:
+            self.write_delta(self.snapshot.record_unit(account, permission_set, rows))
+        self.done_writer.writerow([account['id'], permission_set])
+        self.completed_units.add((account['id'], permission_set))
+        if time.time() - self.last_checkpoint >= checkpoint_interval:
+            self.checkpoint()
+
+    def write_delta(self, delta_rows):
+        self.delta_writer.writerows(delta_rows)
+        self.delta_rows_written += len(delta_rows)
+        self.delta_file.flush()
+
+    def finish(self, unit_keys):
+        # called once every pair of the run is written, records the pairs that are gone in the delta
+        if self.snapshot is not None:
+            self.write_delta(self.snapshot.finish(unit_keys))
+
+    def checkpoint(self):
+        # the report rows must be on disk before the pairs are marked as done, and the pairs must be marked as done
+        # before the snapshot is committed so a resumed run does not compare them against their own rows
+        self.sync(self.file)
+        if self.delta_file is not None:
+            self.sync(self.delta_file)
+        self.sync(self.done_file)
+        if self.snapshot is not None:
+            self.snapshot.commit()
+        self.last_checkpoint = time.time()
+
+    def sync(self, f):
+        f.flush()
+        if isinstance(getattr(f, 'buffer', None), gzip.GzipFile):
+            # flush the compressed stream up to a point a reader can decompress
+            f.buffer.flush(zlib.Z_SYNC_FLUSH)
+            os.fsync(f.buffer.fileobj.fileno())
+        else:
+            os.fsync(f.fileno())
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
+        self.done_file.close()
+        if self.delta_file is not None:
+            self.delta_file.close()
+
+"""
+SnapshotStore
+
+Keeps the report rows of every account and permission set pair, the members of the mapped groups and the permission
+set arns of the last complete run in a sqlite database. A pair is only queried again when CloudTrail has an account
+assignment event for it since the last run, its mapped group or the members of that group changed, its permission set
+was recreated or it is new. Recording a pair returns the rows that were added or removed since the snapshot.
+
+Parameters:
+-- String: filename
+-- Dictionary: sso_instance (an sso instance described by a dictionary with keys 'instanceArn' and 'identityStore')
+-- Dictionary: permission_sets_list (a dictionary with permission sets with key permission set name and value permission set arn)
+-- Boolean: resume (keep the start time of the interrupted run)
+"""
+class SnapshotStore:
+    def __init__(self, filename, sso_instance, permission_sets_list, resume=False):
+        self.filename = filename
+        self.identityStoreId = sso_instance['identityStore']
+        self.permission_sets_list = permission_sets_list
+        self.connection = sqlite3.connect(filename)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS units (account_id TEXT, account_name TEXT, permission_set TEXT, mapped_group TEXT, rows TEXT,
+                                              PRIMARY KEY (account_id, permission_set));
+            CREATE TABLE IF NOT EXISTS group_members (group_id TEXT PRIMARY KEY, member_ids TEXT);
+            CREATE TABLE IF NOT EXISTS permission_sets (name TEXT PRIMARY KEY, arn TEXT);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+        if not resume or self.get_meta('run_started') is None:
+            self.set_meta('run_started', datetime.now(timezone.utc).isoformat())
+            self.commit()
+
+    def get_meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def mapped_group(self, account_id, permission_set):
+        group = find_permission_set_group_mapping(permission_set=permission_set, accountId=account_id, identityStoreId=self.identityStoreId)
+        if not group:
+            return ''
+        return json.dumps({'GroupId': group['GroupId'], 'DisplayName': group['DisplayName']}, sort_keys=True)
+
+    def list_changed_units(self, since):
+        # account assignment events name the account and permission set they changed
+        cloudtrail_client = boto3.client('cloudtrail', config=config)
+        paginator = cloudtrail_client.get_paginator('lookup_events')
+        permission_set_names = {arn: name for name, arn in self.permission_sets_list.items()}
+        changed_units = set()
+        for event_name in ['CreateAccountAssignment', 'DeleteAccountAssignment']:
+            for page in paginator.paginate(LookupAttributes=[{'AttributeKey': 'EventName', 'AttributeValue': event_name}], StartTime=since):
+                for event in page['Events']:
+                    request = json.loads(event['CloudTrailEvent']).get('requestParameters') or {}
+                    permission_set = permission_set_names.get(request.get('permissionSetArn'))
+                    if permission_set is not None:
+                        changed_units.add((request.get('targetId'), permission_set))
+        return changed_units
+
+    def unchanged_units(self, units, executor):
+        last_run = self.get_meta('last_complete_run')
+        if last_run is None:
+            print("No complete snapshot in " + self.filename + ", querying every account/permission set pair")
+            return set()
+        since = datetime.fromisoformat(last_run) - timedelta(seconds=cloudtrail_delay)
+        if since < datetime.now(timezone.utc) - timedelta(days=90):
+            print("The snapshot is older than the CloudTrail event history, querying every account/permission set pair")
+            return set()
+        try:
+            changed_units = self.list_changed_units(since)
+        except ClientError as error:
+            print("[WARN] Could not look up account assignment changes in CloudTrail, querying every account/permission set pair: " + str(error))
+            return set()
+
+        mapped_groups = {(account['id'], permission_set): self.mapped_group(account['id'], permission_set) for account, permission_set in units}
+        group_ids = set(json.loads(group)['GroupId'] for group in mapped_groups.values() if group)
+        identity_resolver = get_identity_resolver(self.identityStoreId)
+        current_members = dict(zip(group_ids, executor.map(identity_resolver.get_group_member_ids, group_ids)))
+        stored_members = {group_id: set(json.loads(member_ids)) for group_id, member_ids in self.connection.execute('SELECT group_id, member_ids FROM group_members')}
+        changed_groups = set(group_id for group_id in group_ids if set(current_members[group_id]) != stored_members.get(group_id))
+        stored_arns = dict(self.connection.execute('SELECT name, arn FROM permission_sets'))
+        stored_units = {(account_id, permission_set): (account_name, mapped_group) for account_id, account_name, permission_set, mapped_group
+                        in self.connection.execute('SELECT account_id, account_name, permission_set, mapped_group FROM units')}
+
+        unchanged_units = set()
+        for account, permission_set in units:
+            key = (account['id'], permission_set)
+            group = mapped_groups[key]
+            if key not in stored_units or key in changed_units:
+                continue
+            if stored_arns.get(permission_set) != self.permission_sets_list[permission_set]:
+                continue
+            if stored_units[key] != (account['name'], group):
+                continue
+            if group and json.loads(group)['GroupId'] in changed_groups:
+                continue
+            unchanged_units.add(key)
+        print(str(len(units) - len(unchanged_units)) + " of " + str(len(units)) + " account/permission set pairs changed since " + last_run
+              + " (" + str(len(changed_units)) + " assignment changes, " + str(len(changed_groups)) + " groups with changed members)")
+        return unchanged_units
+
+    def get_rows(self, account_id, permission_set):
+        row = self.connection.execute('SELECT rows FROM units WHERE account_id = ? AND permission_set = ?', (account_id, permission_set)).fetchone()
+        return json.loads(row[0])
+
+    def diff(self, old_rows, new_rows):
+        old = Counter(tuple(row.get(name) for name in report_fieldnames) for row in old_rows)
+        new = Counter(tuple(row.get(name) for name in report_fieldnames) for row in new_rows)
+        delta = []
+        for change, rows, counts in [('Removed', old_rows, old - new), ('Added', new_rows, new - old)]:
+            for row in rows:
+                values = tuple(row.get(name) for name in report_fieldnames)
+                if counts[values] > 0:
+                    counts[values] -= 1
+                    delta.append(dict(row, Change=change))
+        return delta
+
+    def record_unit(self, account, permission_set, rows):
+        previous = self.connection.execute('SELECT rows FROM units WHERE account_id = ? AND permission_set = ?', (account['id'], permission_set)).fetchone()
+        delta = self.diff(json.loads(previous[0]) if previous else [], rows)
+        self.connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)', (
+            account['id'], account['name'], permission_set, self.mapped_group(account['id'], permission_set), json.dumps(rows, default=str)
+        ))
+        return delta
+
+    def finish(self, unit_keys):
+        delta = []
+        for account_id, permission_set, rows in self.connection.execute('SELECT account_id, permission_set, rows FROM units').fetchall():
+            if (account_id, permission_set) not in unit_keys:
+                delta.extend(self.diff(json.loads(rows), []))
+                self.connection.execute('DELETE FROM units WHERE account_id = ? AND permission_set = ?', (account_id, permission_set))
+
+        # the members the rows were built from, compared with the current members by the next run
+        identity_resolver = get_identity_resolver(self.identityStoreId)
+        group_ids = set(json.loads(group)['GroupId'] for (group,) in self.connection.execute('SELECT DISTINCT mapped_group FROM units') if group)
+        self.connection.execute('DELETE FROM group_members')
+        self.connection.executemany('INSERT INTO group_members VALUES (?, ?)', [
+            (group_id, json.dumps(sorted(identity_resolver.get_group_member_ids(group_id)))) for group_id in group_ids
+        ])
+        self.connection.execute('DELETE FROM permission_sets')
+        self.connection.executemany('INSERT INTO permission_sets VALUES (?, ?)', self.permission_sets_list.items())
+        self.set_meta('last_complete_run', self.get_meta('run_started'))
+        self.commit()
+        return delta
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+"""
+report_filename
+
+Builds the default report filename.
+
+Parameters:
+-- String: output_format (csv, csv.gz or parquet)
+Returns:
+-- String: filename
+"""
+def report_filename(output_format):
+    extension = '.csv.gz' if output_format == 'csv.gz' else '.csv'
+    filename = 'sso_report_Account_Assignments_' + datetime.now().strftime("%Y-%m-%d_%H.%M.%S") + extension
+    return clean_filename(filename)
+
+"""
+write_parquet
+
+Converts the finished csv report to a parquet file next to it. Needs pyarrow, which is not installed by requirements.txt.
+
+Parameters:
+-- String: filename (the csv report)
+Returns:
+-- String: parquet_filename (None when pyarrow is not installed)
+"""
+def write_parquet(filename):
+    try:
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        print("[WARN] pyarrow is not installed, only the csv report was written")
+        return None
+    parquet_filename = filename[:-len('.gz')] if filename.endswith('.gz') else filename
+    parquet_filename = parquet_filename[:-len('.csv')] + '.parquet'
+    # read every column as a string, account ids keep their leading zeros
+    convert_options = pyarrow.csv.ConvertOptions(column_types={name: pyarrow.string() for name in report_fieldnames})
+    table = pyarrow.csv.read_csv(filename, convert_options=convert_options)
+    pyarrow.parquet.write_table(table, parquet_filename)
+    return parquet_filename
 
 def print_time_taken(start, end):
     elapsed_time = end - start
@@ -437,14 +1061,45 @@ Output:
 -- CSV file: CSV with SSO report.
 """
 def main():
-  
+    parser = argparse.ArgumentParser(description='Report on the SSO account assignments of the organization.')
+    parser.add_argument('--format', dest='output_format', choices=['csv', 'csv.gz', 'parquet'], default='csv',
+                        help='report format, parquet is converted from the csv report once it is complete')
+    parser.add_argument('--resume', metavar='REPORT_FILE',
+                        help='continue an interrupted run, skipping the account/permission set pairs already in REPORT_FILE')
+    parser.add_argument('--full', action='store_true',
+                        help='query every account/permission set pair instead of only the ones changed since the last snapshot')
+    args = parser.parse_args()
+
     dry_run = True
     start = time.time()
     account_list = list_accounts()
     sso_instance = list_existing_sso_instances()[0]
     permission_sets_list = list_permission_sets(sso_instance['instanceArn'])
-    result = create_report(account_list, sso_instance, permission_sets_list, dry_run=dry_run)
-    write_result_to_file(result)
+    snapshot = None
+    if snapshot_file:
+        snapshot = SnapshotStore(snapshot_file, sso_instance, permission_sets_list, resume=bool(args.resume))
+    if args.resume:
+        report_writer = ReportWriter(args.resume, resume=True, snapshot=snapshot)
+    else:
+        report_writer = ReportWriter(report_filename(args.output_format), snapshot=snapshot)
+    try:
+        create_report(account_list, sso_instance, permission_sets_list, report_writer, snapshot=snapshot, full=args.full, dry_run=dry_run)
+    finally:
+        # whatever was written so far can be resumed with --resume
+        report_writer.close()
+        if snapshot is not None:
+            snapshot.close()
+    print("Wrote " + str(report_writer.rows_written) + " rows to " + report_writer.filename)
+    if snapshot is not None:
+        print("Wrote " + str(report_writer.delta_rows_written) + " added or removed rows to " + report_writer.delta_filename)
+    if args.output_format == 'parquet':
+        parquet_filename = write_parquet(report_writer.filename)
+        if parquet_filename:
+            print("Wrote " + parquet_filename)
+
+    identity_resolver = get_identity_resolver(sso_instance['identityStore'])
+    identity_resolver.save()
+    identity_resolver.print_stats()
 
     # print the time it took to generate the report
     end = time.time()
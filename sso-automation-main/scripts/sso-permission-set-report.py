@@ -1,12 +1,33 @@
 import boto3
 import csv
+import hashlib
 import json
+import os
 import string
 import time
 import unicodedata
 
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# Number of permission sets described and fetched concurrently
+max_workers = 16
+# Permission set names by arn are kept on disk between runs (None disables the file)
+permission_set_cache_file = './permission-set-cache.json'
+# Inline policies are stored once per distinct policy document in this directory, see store_policy
+policy_store_directory = './policy-store'
+
+# 'adaptive' retry mode backs off when SSO Admin returns throttling errors, the client is shared by the worker threads
+config = Config(
+    retries={
+        'max_attempts': 20,
+        'mode': 'adaptive'
+    },
+    max_pool_connections=max_workers
+)
+sso_admin_client = boto3.client('sso-admin', config=config)
+
 """
 list_existing_sso_instances
 
@@ -18,7 +39,7 @@ Returns:
 -- List[Dictionary]: sso_instance_list (a list of sso instances each described by a dictionary with keys 'instanceArn' and 'identityStore')
 """
 def list_existing_sso_instances():
-    client = boto3.client('sso-admin')
+    client = sso_admin_client
 
     sso_instance_list = []
     response = client.list_instances()
@@ -39,7 +60,7 @@ Returns:
 -- Dictionary: perm_set_dict (a dictionary with permission sets with key permission set name and value permission set arn)
 """
 def list_permission_sets(ssoInstanceArn):
-    client = boto3.client('sso-admin')
+    client = sso_admin_client
 
     perm_set_dict = {}
     response = client.list_permission_sets(InstanceArn=ssoInstanceArn, MaxResults=100)
@@ -49,67 +70,184 @@ def list_permission_sets(ssoInstanceArn):
         response = client.list_permission_sets(InstanceArn=ssoInstanceArn, NextToken=response["NextToken"])
         results.extend(response["PermissionSets"]) 
 
+    # get the names of the permission sets from the arns
+    names = describe_permission_set_names(ssoInstanceArn, results)
     for permission_set in results:
-        # get the name of the permission set from the arn
-        perm_description = client.describe_permission_set(InstanceArn=ssoInstanceArn,PermissionSetArn=permission_set)
         # key: permission set name, value: permission set arn
-        perm_set_dict[perm_description["PermissionSet"]["Name"]] = permission_set
+        perm_set_dict[names[permission_set]] = permission_set
 
     return perm_set_dict
 
+"""
+describe_permission_set_names
+
+Looks up the names of permission sets. Names are read from permission_set_cache_file and the permission sets that are
+not in it are described concurrently. A permission set cannot be renamed (a new name replaces it with a new arn), so
+cached names do not go stale and only the current arns are written back to the file.
+
+Parameters:
+-- String: ssoInstanceArn
+-- List[String]: permission_set_arns
+Returns:
+-- Dictionary: names (a dictionary with key permission set arn and value permission set name)
+"""
+def describe_permission_set_names(ssoInstanceArn, permission_set_arns):
+    cached_names = {}
+    if permission_set_cache_file and os.path.exists(permission_set_cache_file):
+        try:
+            with open(permission_set_cache_file) as f:
+                cached_names = json.load(f)
+        except ValueError:
+            print("[WARN] Ignoring unreadable permission set cache file " + permission_set_cache_file)
+
+    missing = [arn for arn in permission_set_arns if arn not in cached_names]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        described = executor.map(
+            lambda arn: sso_admin_client.describe_permission_set(InstanceArn=ssoInstanceArn, PermissionSetArn=arn)["PermissionSet"]["Name"],
+            missing
+        )
+        cached_names.update(zip(missing, described))
+    print("Described " + str(len(missing)) + " of " + str(len(permission_set_arns)) + " permission sets, the others were cached")
+
+    names = {arn: cached_names[arn] for arn in permission_set_arns}
+    if permission_set_cache_file:
+        with open(permission_set_cache_file + '.tmp', 'w') as f:
+            json.dump(names, f, indent=2)
+        os.replace(permission_set_cache_file + '.tmp', permission_set_cache_file)
+    return names
+
+"""
+get_permission_set_policies
+
+Retrieves every policy attached to a permission set: the AWS managed policies, the customer managed policy references,
+the permissions boundary and the inline policy.
+
+Parameters:
+-- String: ssoInstanceArn
+-- String: permissionSetArn
+Returns:
+-- Dictionary: policies (a dictionary with keys 'ManagedPolicies', 'CustomerManagedPolicyReferences', 'PermissionsBoundary'
+   (None if there is none) and 'InlinePolicy' (an empty string if there is none))
+"""
+def get_permission_set_policies(ssoInstanceArn, permissionSetArn):
+    client = sso_admin_client
+    policies = {'ManagedPolicies': [], 'CustomerManagedPolicyReferences': [], 'PermissionsBoundary': None}
+
+    paginator = client.get_paginator('list_managed_policies_in_permission_set')
+    for page in paginator.paginate(InstanceArn=ssoInstanceArn, PermissionSetArn=permissionSetArn):
+        policies['ManagedPolicies'].extend(page['AttachedManagedPolicies'])
+
+    paginator = client.get_paginator('list_customer_managed_policy_references_in_permission_set')
+    for page in paginator.paginate(InstanceArn=ssoInstanceArn, PermissionSetArn=permissionSetArn):
+        policies['CustomerManagedPolicyReferences'].extend(page['CustomerManagedPolicyReferences'])
+
+    try:
+        response = client.get_permissions_boundary_for_permission_set(InstanceArn=ssoInstanceArn, PermissionSetArn=permissionSetArn)
+        policies['PermissionsBoundary'] = response['PermissionsBoundary']
+    except client.exceptions.ResourceNotFoundException:
+        # the permission set has no permissions boundary
+        pass
+
+    response = client.get_inline_policy_for_permission_set(InstanceArn=ssoInstanceArn, PermissionSetArn=permissionSetArn)
+    policies['InlinePolicy'] = response['InlinePolicy']
+    return policies
+
+"""
+store_policy
+
+Stores an inline policy in policy_store_directory under the sha256 of its canonical JSON (sorted keys, no whitespace),
+so permission sets with the same policy share one file. A file that already exists is not written again, which keeps
+unchanged policies untouched between runs. Each distinct policy string is only parsed once per run.
+
+Parameters:
+-- String: policy_document (the inline policy as returned by get_inline_policy_for_permission_set)
+Returns:
+-- Tuple: (policy_hash, file_path)
+"""
+stored_policies = {}
+def store_policy(policy_document):
+    if policy_document in stored_policies:
+        return stored_policies[policy_document]
+
+    policy = json.loads(policy_document)
+    canonical = json.dumps(policy, sort_keys=True, separators=(',', ':'))
+    policy_hash = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    file_path = policy_store_directory + '/' + policy_hash + '.json'
+    if not os.path.exists(file_path):
+        os.makedirs(policy_store_directory, exist_ok=True)
+        with open(file_path + '.tmp', 'w', newline='') as json_output_file:
+            json_output_file.write(json.dumps(policy, indent=2))
+        os.replace(file_path + '.tmp', file_path)
+
+    stored_policies[policy_document] = (policy_hash, file_path)
+    return stored_policies[policy_document]
+
 """
 create_report
 
-Creates a report of the assigned permissions on users for all accounts in an organization.
+Creates a report of the policies attached to all permission sets. The policies of the permission sets are retrieved
+concurrently and written in permission set order.
 
 Parameters:
--- List[Dictionary]: sso_instance (a list of sso instances each described by a dictionary with keys 'instanceArn' and 'identityStore')
+-- Dictionary: sso_instance (an sso instance described by a dictionary with keys 'instanceArn' and 'identityStore')
 -- Dictionary: permission_sets_list (a dictionary with permission sets with key permission set name and value permission set arn)
 Returns:
 -- None
 Output:
--- CSV file: CSV with permissions set report
--- Json files: Json files with inline policies attached to permission sets if any
+-- CSV file: CSV with the managed policies, customer managed policy references and permissions boundaries per permission set
+-- JSON Lines file: the inline policy of each permission set that has one, pointing at the policy in policy_store_directory
+-- JSON files: one file per distinct inline policy in policy_store_directory
 """
 def create_report(sso_instance, permission_sets_list, break_after=None):
-    client = boto3.client('sso-admin')
+    permission_sets = list(permission_sets_list.keys())
+    # debug code used for stopping after a certain amount of permission sets for faster testing
+    if break_after != None:
+        permission_sets = permission_sets[:break_after]
 
-    # variables for displaying the progress of processed accounts
-    length = str(len(permission_sets_list))
+    # variables for displaying the progress of processed permission sets
+    length = str(len(permission_sets))
     i = 1
 
-    # loop through permission sets and write details to file
-    filename = 'sso_report_Managed_Policies_per_Permission_Set_' + datetime.now().strftime("%Y-%m-%d_%H.%M.%S") + '.csv'
-    filename = clean_filename(filename)
-    with open(filename, 'w', newline='') as output_file:
-        output_file.write("PermissionSet,ManagedPolicyName,ManagedPolicyARN\n")
-        for permission_set in permission_sets_list.keys():
-            managed_policies = client.list_managed_policies_in_permission_set(InstanceArn=sso_instance['instanceArn'],PermissionSetArn=permission_sets_list[permission_set])
-
-
-            # create managed policy csv file if there are any managed policies attached to the permission set
-            if(len(managed_policies['AttachedManagedPolicies']) > 0):
-                for m_policy in managed_policies["AttachedManagedPolicies"]:
-                    output_file.write(permission_set + "," + m_policy["Name"] + "," + m_policy["Arn"] + "\n")
-
-
-            # create inline policy json file if there is an inline policy attached to the permission set
-            inline_policy = client.get_inline_policy_for_permission_set(InstanceArn=sso_instance['instanceArn'],PermissionSetArn=permission_sets_list[permission_set])
-            if(inline_policy["InlinePolicy"] != ''):
-                json_filename = 'sso_report_InlinePolicy_for_' + permission_set + '_' + datetime.now().strftime("%Y-%m-%d_%H.%M.%S") + '.json'
-                json_filename = clean_filename(json_filename)
-                with open(json_filename, 'w', newline='') as json_output_file:
-                    json_object = json.loads(inline_policy["InlinePolicy"])
-                    json_output_file.write(json.dumps(json_object, indent=2))
-                    json_output_file.close()
-
-            # display the progress of processed accounts
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H.%M.%S")
+    filename = clean_filename('sso_report_Managed_Policies_per_Permission_Set_' + timestamp + '.csv')
+    jsonl_filename = clean_filename('sso_report_InlinePolicies_' + timestamp + '.jsonl')
+    with open(filename, 'w', newline='') as output_file, open(jsonl_filename, 'w', newline='') as jsonl_output_file, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        writer = csv.writer(output_file)
+        writer.writerow(['PermissionSet', 'ManagedPolicyName', 'ManagedPolicyARN', 'PolicyType', 'ManagedPolicyPath'])
+
+        # executor.map returns the results in permission set order while later permission sets are still being fetched
+        all_policies = executor.map(
+            lambda permission_set: get_permission_set_policies(sso_instance['instanceArn'], permission_sets_list[permission_set]),
+            permission_sets
+        )
+        for permission_set, policies in zip(permission_sets, all_policies):
+            for m_policy in policies['ManagedPolicies']:
+                writer.writerow([permission_set, m_policy['Name'], m_policy['Arn'], 'AWSManaged', ''])
+            for c_policy in policies['CustomerManagedPolicyReferences']:
+                writer.writerow([permission_set, c_policy['Name'], '', 'CustomerManaged', c_policy.get('Path', '/')])
+            boundary = policies['PermissionsBoundary']
+            if boundary is not None:
+                if 'ManagedPolicyArn' in boundary:
+                    writer.writerow([permission_set, boundary['ManagedPolicyArn'].split('/')[-1], boundary['ManagedPolicyArn'], 'PermissionsBoundary', ''])
+                else:
+                    reference = boundary['CustomerManagedPolicyReference']
+                    writer.writerow([permission_set, reference['Name'], '', 'PermissionsBoundary', reference.get('Path', '/')])
+
+            # add a line for the inline policy if there is an inline policy attached to the permission set
+            if policies['InlinePolicy'] != '':
+                policy_hash, policy_file = store_policy(policies['InlinePolicy'])
+                jsonl_output_file.write(json.dumps({
+                    'PermissionSet': permission_set,
+                    'PermissionSetArn': permission_sets_list[permission_set],
+                    'InlinePolicyHash': policy_hash,
+                    'InlinePolicyFile': policy_file
+                }) + "\n")
+
+            # display the progress of processed permission sets
             print(str(i) + "/" + length + " permission sets done")
             i = i+1
-
-            # debug code used for stopping after a certain amount of accounts for faster testing
-            if break_after != None and i > break_after:
-                break
+    print(str(len({policy_hash for policy_hash, _ in stored_policies.values()})) + " distinct inline policies in " + policy_store_directory)
 
 def print_time_taken(start, end):
     elapsed_time = end - start